@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""Benchmarks of the hot paths of TeXWriter that do not need a display.
+
+Usage:
+    python3 benchmarks/run.py [-o results.json] [--compare old.json]
+                              [--quick] [-k FILTER]
+
+Results are written as JSON, one entry per benchmark with the minimum,
+median and mean time of the repeats in seconds. With --compare, the ratio
+of the median times to those of an earlier run is printed, so performance
+can be compared between commits.
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from texwriter.completion import (CompletionIndex, CompletionRanker,
+                                  merge_commands, parse_completion_xml)
+from texwriter.logparser import parse_log
+from texwriter.pagecache import PageCache, get_tiles
+from texwriter.synctex import parse_view
+from texwriter.tokenizer import group_spans, tokenize
+import synthetic
+
+SIZES = (1000, 10000, 100000)
+QUICK_SIZES = (1000, 10000)
+# Queries typed one character at a time in the completion benchmark.
+QUERIES = ("\\begin", "\\section", "\\mathbb", "\\frac", "\\usepackage",
+           "\\textbf", "\\alpha", "\\includegraphics")
+# Number of results shown in the completion popover.
+MAX_RESULTS = 50
+
+
+def measure(func, repeat, min_time=0.2):
+    """Time `func` at least `repeat` times and for at least `min_time`
+    seconds. Returns the list of times."""
+    times = []
+    start = time.perf_counter()
+    while len(times) < repeat or time.perf_counter() - start < min_time:
+        t = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t)
+        if len(times) >= 1000:
+            break
+    return times
+
+
+def bench_highlight(size):
+    text = synthetic.document(size)
+    def run():
+        tokens = tokenize(text)
+        group_spans(tokens)
+    return run
+
+
+def bench_log(size):
+    text = synthetic.log(size)
+    return lambda: parse_log(text)
+
+
+def bench_synctex(size):
+    # One record for every 100 lines, like a SyncTeX query of a long
+    # paragraph.
+    text = synthetic.synctex_view(max(1, size // 100))
+    return lambda: parse_view(text)
+
+
+def load_completion_commands():
+    packages = []
+    for path in sorted(glob.glob(os.path.join(ROOT, "data", "completion", "*.xml"))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        with open(path, encoding="utf-8") as f:
+            packages.append(parse_completion_xml(f.read(), name))
+    return merge_commands(packages)
+
+
+def bench_completion_index(_size):
+    commands = load_completion_commands()
+    texts = [cmd['text'] for cmd in commands]
+    return lambda: CompletionIndex(texts)
+
+
+def bench_completion_typing(_size):
+    commands = load_completion_commands()
+    index = CompletionIndex(cmd['text'] for cmd in commands)
+    lowpriority = [cmd['lowpriority'] for cmd in commands]
+    def run():
+        ranker = CompletionRanker(index, lowpriority, {})
+        for query in QUERIES:
+            for n in range(1, len(query) + 1):
+                ranker.rank(query[:n], MAX_RESULTS)
+    return run
+
+
+def bench_page_cache(size):
+    # Scroll through `size` // 100 A4 pages at 200% zoom, looking up the
+    # visible tiles of each page, with room for a tenth of them in the cache.
+    pages = max(1, size // 100)
+    width, height = 1190, 1684
+    tile_bytes = 1024 * 1024 * 4
+    cache = PageCache(tile_bytes * max(1, pages // 10) * 4)
+    def run():
+        for page in range(pages):
+            for y in range(0, height, 400):
+                for tile in get_tiles(width, height, (0, y, width, 800)):
+                    key = (page, 2.0, tile[0], tile[1])
+                    if cache.get(key) is None:
+                        cache.put(key, None, tile[2] * tile[3] * 4)
+    return run
+
+
+# Name, setup function taking the size, and whether it depends on the size.
+BENCHMARKS = [
+    ("highlight", bench_highlight, True),
+    ("log-parse", bench_log, True),
+    ("synctex-parse", bench_synctex, True),
+    ("page-cache", bench_page_cache, True),
+    ("completion-index", bench_completion_index, False),
+    ("completion-typing", bench_completion_typing, False),
+]
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes, name_filter, repeat):
+    results = []
+    for name, setup, sized in BENCHMARKS:
+        if name_filter and name_filter not in name:
+            continue
+        for size in sizes if sized else (None,):
+            func = setup(size)
+            times = measure(func, repeat)
+            result = {
+                "name": name if size is None else f"{name}[{size}]",
+                "size": size,
+                "repeat": len(times),
+                "min": min(times),
+                "median": statistics.median(times),
+                "mean": statistics.fmean(times),
+            }
+            results.append(result)
+            print(f"{result['name']:28} median {result['median'] * 1000:10.3f} ms"
+                  f"  min {result['min'] * 1000:10.3f} ms", file=sys.stderr)
+    return results
+
+
+def compare(results, path):
+    with open(path, encoding="utf-8") as f:
+        old = {r["name"]: r for r in json.load(f)["results"]}
+    print(f"{'benchmark':28} {'old':>12} {'new':>12} {'ratio':>7}")
+    for result in results:
+        before = old.get(result["name"])
+        if before is None:
+            continue
+        ratio = result["median"] / before["median"]
+        print(f"{result['name']:28} {before['median'] * 1000:10.3f}ms"
+              f" {result['median'] * 1000:10.3f}ms {ratio:7.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-o", "--output", help="write the results to this file")
+    parser.add_argument("--compare", help="compare with the results in this file")
+    parser.add_argument("--quick", action="store_true",
+                        help="skip the largest inputs")
+    parser.add_argument("-k", dest="filter", help="only run matching benchmarks")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="minimum number of repeats (default: 5)")
+    args = parser.parse_args()
+
+    sizes = QUICK_SIZES if args.quick else SIZES
+    results = run_benchmarks(sizes, args.filter, args.repeat)
+    data = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.time(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+    else:
+        json.dump(data, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Generators of synthetic LaTeX documents and compiler outputs.
+
+The generators are deterministic, so every run benchmarks the same input.
+"""
+
+import random
+
+PACKAGES = ["amsmath", "amssymb", "graphicx", "hyperref", "geometry",
+            "xcolor", "amsthm", "url"]
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+
+
+def document(lines, seed=0):
+    """Return a LaTeX document of about `lines` lines."""
+    rng = random.Random(seed)
+    out = ["\\documentclass{book}"]
+    out.extend("\\usepackage{" + pkg + "}" for pkg in PACKAGES)
+    out.append("\\begin{document}")
+    n = 0
+    while len(out) < lines - 1:
+        n += 1
+        r = rng.random()
+        if r < 0.02:
+            out.append("\\chapter{Chapter %d}\\label{ch:%d}" % (n, n))
+        elif r < 0.08:
+            out.append("\\section{Section %d}\\label{sec:%d}" % (n, n))
+        elif r < 0.20:
+            out.append("")
+        elif r < 0.25:
+            out.append("% a comment about " + " ".join(rng.sample(WORDS, 4)))
+        elif r < 0.30:
+            out.append("\\begin{equation}\\label{eq:%d}" % n)
+            out.append("  \\int_0^1 f(x)\\,dx = \\sum_{k=0}^\\infty a_k \\\\")
+            out.append("\\end{equation}")
+        else:
+            words = [rng.choice(WORDS) for _ in range(rng.randint(6, 14))]
+            if rng.random() < 0.4:
+                words.insert(rng.randrange(len(words)), "$x^{%d} + y$" % n)
+            if rng.random() < 0.2:
+                words.append("see \\ref{sec:%d}" % rng.randint(1, n))
+            if rng.random() < 0.2:
+                words.insert(0, "\\emph{%s}" % rng.choice(WORDS))
+            out.append(" ".join(words))
+    out.append("\\end{document}")
+    return "\n".join(out) + "\n"
+
+
+def log(lines, seed=0):
+    """Return a pdflatex log of about `lines` lines."""
+    rng = random.Random(seed)
+    out = ["This is pdfTeX, Version 3.141592653-2.6-1.40.25 (TeX Live 2023)",
+           "entering extended mode"]
+    while len(out) < lines:
+        r = rng.random()
+        line = rng.randint(1, 100000)
+        if r < 0.05:
+            out.append("Overfull \\hbox (%.5fpt too wide) in paragraph at lines %d--%d"
+                       % (rng.random() * 20, line, line + 3))
+            out.append("[]\\OT1/cmr/m/n/10 " + " ".join(rng.sample(WORDS, 5)))
+            out.append("")
+        elif r < 0.08:
+            out.append("LaTeX Warning: Reference `sec:%d' on page %d undefined on input line %d."
+                       % (line, rng.randint(1, 400), line))
+            out.append("")
+        elif r < 0.09:
+            out.append("! Undefined control sequence.")
+            out.append("l.%d \\foo" % line)
+            out.append("")
+        elif r < 0.20:
+            out.append("(/usr/share/texlive/texmf-dist/tex/latex/base/size%d.clo"
+                       % rng.randint(10, 12))
+        else:
+            out.append("[%d] " % rng.randint(1, 400) + " ".join(rng.sample(WORDS, 3)))
+    return "\n".join(out) + "\n"
+
+
+def synctex_view(records, seed=0):
+    """Return the output of `synctex view` with `records` records."""
+    rng = random.Random(seed)
+    out = ["This is SyncTeX command line utility, version 1.5",
+           "SyncTeX result begin"]
+    for _ in range(records):
+        out.append("Output:/tmp/document.pdf")
+        out.append("Page:%d" % rng.randint(1, 400))
+        out.append("x:%.2f" % (rng.random() * 400))
+        out.append("y:%.2f" % (rng.random() * 700))
+        out.append("h:%.2f" % (rng.random() * 400))
+        out.append("v:%.2f" % (rng.random() * 700))
+        out.append("W:%.2f" % (rng.random() * 300))
+        out.append("H:%.2f" % (rng.random() * 12))
+        out.append("before:")
+        out.append("offset:0")
+        out.append("middle:")
+        out.append("after:")
+    out.append("SyncTeX result end")
+    return "\n".join(out) + "\n"
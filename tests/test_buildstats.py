@@ -0,0 +1,62 @@
+import json
+import unittest
+
+from texwriter.buildstats import (CANCELLED, FAILED, SUCCESS, BuildHistory,
+                                  BuildRecord)
+
+
+class BuildRecordTest(unittest.TestCase):
+
+    def test_stages(self):
+        record = BuildRecord("main.tex")
+        record.begin("save")
+        self.assertTrue(record.running)
+        record.end("save")
+        record.begin("latex")
+        record.begin("log")
+        record.end("log")
+        self.assertTrue(record.running)
+        record.end("latex", FAILED)
+        self.assertFalse(record.running)
+        self.assertEqual([stage[0] for stage in record.stages],
+                         ["save", "latex", "log"])
+        self.assertEqual(record.outcome, FAILED)
+        self.assertEqual(record.duration, record.end_time)
+
+    def test_ends_last_running_stage(self):
+        record = BuildRecord("main.tex")
+        record.begin("latex")
+        record.end("latex")
+        record.begin("latex")
+        record.end("latex", CANCELLED)
+        self.assertEqual([stage[3] for stage in record.stages],
+                         [SUCCESS, CANCELLED])
+        self.assertEqual(record.outcome, CANCELLED)
+
+    def test_to_dict(self):
+        record = BuildRecord("main.tex", draft=True)
+        record.begin("latex")
+        data = record.to_dict()
+        self.assertEqual(data["document"], "main.tex")
+        self.assertTrue(data["draft"])
+        self.assertTrue(data["running"])
+        self.assertEqual(data["outcome"], SUCCESS)
+        self.assertEqual(data["stages"][0]["name"], "latex")
+        self.assertIsNone(data["stages"][0]["duration"])
+
+
+class BuildHistoryTest(unittest.TestCase):
+
+    def test_keeps_most_recent(self):
+        history = BuildHistory(maxlen=2)
+        for name in ("a", "b", "c"):
+            history.add(BuildRecord(name))
+        self.assertEqual([record.document for record in history], ["b", "c"])
+        self.assertEqual(len(history), 2)
+        self.assertEqual([record["document"]
+                          for record in json.loads(history.to_json())],
+                         ["b", "c"])
+
+
+if __name__ == "__main__":
+    unittest.main()
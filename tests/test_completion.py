@@ -0,0 +1,133 @@
+import os
+import tempfile
+import unittest
+
+from texwriter.completion import (CompletionIndex, CompletionRanker,
+                                  fuzzy_match, fuzzy_score, merge_commands,
+                                  parse_completion_xml, read_cache,
+                                  write_cache)
+
+XML = """<commands>
+  <command name="\\geometry{•}" text="\\geometry{#}" lowpriority="False"
+           description="Page layout" dotlabels="options###" />
+  <environment name="center" text="center" lowpriority="True"
+               description="" dotlabels="" />
+</commands>
+"""
+
+TEXTS = ["\\alpha", "\\label{•}", "\\section{•}", "\\emph{•}", "\\ref{•}",
+         "\\begin{align}...\\end{align}"]
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_parse_completion_xml(self):
+        command, environment = parse_completion_xml(XML, "geometry")
+        self.assertEqual(command, {"package": "geometry",
+                                   "command": "\\geometry{#}",
+                                   "text": "\\geometry{•}",
+                                   "description": "Page layout",
+                                   "lowpriority": False,
+                                   "dotlabels": "options###"})
+        self.assertEqual(environment["command"],
+                         "\\begin{center}\n\\end{center}")
+        self.assertEqual(environment["text"],
+                         "\\begin{center}...\\end{center}")
+        self.assertTrue(environment["lowpriority"])
+
+    def test_merge_commands_keeps_first(self):
+        first = [{"text": "\\a", "package": "x"}]
+        second = [{"text": "\\a", "package": "y"}, {"text": "\\b", "package": "y"}]
+        self.assertEqual(merge_commands([first, second]),
+                         [{"text": "\\a", "package": "x"},
+                          {"text": "\\b", "package": "y"}])
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cache", "geometry.json")
+            self.assertIsNone(read_cache(path, "abc"))
+            write_cache(path, "abc", [{"text": "\\a"}])
+            self.assertEqual(read_cache(path, "abc"), [{"text": "\\a"}])
+            self.assertIsNone(read_cache(path, "def"))
+
+
+class FuzzyScoreTest(unittest.TestCase):
+
+    def test_no_match(self):
+        self.assertIsNone(fuzzy_score("\\lx", "\\label{•}"))
+        self.assertIsNone(fuzzy_score("ba", "\\abc"))
+
+    def test_prefix_beats_subsequence(self):
+        self.assertGreater(fuzzy_score("\\la", "\\label{•}"),
+                           fuzzy_score("\\la", "\\alpha"))
+
+    def test_word_start_beats_gap(self):
+        self.assertGreater(fuzzy_score("\\ba", "\\begin{align}"),
+                           fuzzy_score("\\ba", "\\tabular"))
+
+    def test_shorter_text_wins_ties(self):
+        self.assertGreater(fuzzy_score("\\re", "\\ref"),
+                           fuzzy_score("\\re", "\\refx"))
+
+
+class CompletionIndexTest(unittest.TestCase):
+
+    def test_search_chars(self):
+        index = CompletionIndex(TEXTS)
+        self.assertEqual(index.search_chars("\\la"), {0, 1, 5})
+        self.assertEqual(index.search_chars("\\"), set(range(len(TEXTS))))
+        self.assertEqual(index.search_chars("z"), set())
+
+    def test_match_pair(self):
+        index = CompletionIndex(TEXTS + ["a\\l"])
+        for pair in ("\\l", "\\{", "a\\", "zz"):
+            expected = sorted((i, *fuzzy_match(pair, text))
+                              for i, text in enumerate(index.texts)
+                              if fuzzy_match(pair, text))
+            self.assertEqual(sorted(index.match_pair(pair)), expected)
+
+
+class CompletionRankerTest(unittest.TestCase):
+
+    def make_ranker(self, usage=None, lowpriority=None):
+        index = CompletionIndex(TEXTS)
+        if lowpriority is None:
+            lowpriority = [False] * len(TEXTS)
+        if usage is None:
+            usage = {}
+        return CompletionRanker(index, lowpriority, usage)
+
+    def best(self, ranker, query, n=10):
+        return [TEXTS[i] for i in ranker.rank(query, n)]
+
+    def test_rank(self):
+        ranker = self.make_ranker()
+        self.assertEqual(self.best(ranker, "\\la"),
+                         ["\\label{•}", "\\begin{align}...\\end{align}",
+                          "\\alpha"])
+        self.assertEqual(self.best(ranker, "\\la", 1), ["\\label{•}"])
+
+    def test_extended_query(self):
+        ranker = self.make_ranker()
+        for query in ("\\", "\\e", "\\em", "\\e", "\\s"):
+            expected = self.make_ranker().rank(query, 10)
+            self.assertEqual(ranker.rank(query, 10), expected)
+
+    def test_usage_and_priority(self):
+        ranker = self.make_ranker(usage={"\\alpha": 1000})
+        self.assertEqual(self.best(ranker, "\\la", 1), ["\\alpha"])
+        lowpriority = [text == "\\alpha" for text in TEXTS]
+        ranker = self.make_ranker(lowpriority=lowpriority)
+        self.assertEqual(self.best(ranker, "\\", 1), ["\\ref{•}"])
+
+    def test_reset(self):
+        usage = {}
+        ranker = self.make_ranker(usage=usage)
+        self.assertEqual(self.best(ranker, "\\", 1), ["\\alpha"])
+        usage["\\emph{•}"] = 5
+        ranker.reset()
+        self.assertEqual(self.best(ranker, "\\", 1), ["\\emph{•}"])
+
+
+if __name__ == "__main__":
+    unittest.main()
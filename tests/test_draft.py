@@ -0,0 +1,71 @@
+import unittest
+
+from texwriter.draft import draft_document, tex_file_name
+from texwriter.preamble import get_preamble
+
+BOOK = """\\documentclass{book}
+\\begin{document}
+\\chapter{One}\\label{one}
+See \\ref{two}.
+\\chapter{Two}\\label{two}
+Text.
+\\include{three}
+\\end{document}
+"""
+
+
+class TexFileNameTest(unittest.TestCase):
+
+    def test_plain(self):
+        self.assertEqual(tex_file_name("main.aux"), "\\detokenize{main.aux}")
+
+    def test_special_characters(self):
+        name = "my thesis_v2~%#{x}.aux"
+        self.assertEqual(tex_file_name(name),
+                         "\\detokenize{my thesis_v2~}\\@percentchar\\string#"
+                         "\\@charlb\\detokenize{x}\\@charrb\\detokenize{.aux}")
+
+    def test_braces_balanced(self):
+        code = tex_file_name("a}b{c%")
+        self.assertEqual(code.count("{"), code.count("}"))
+        self.assertNotIn("%", code)
+
+
+class DraftDocumentTest(unittest.TestCase):
+
+    def test_section_keeps_line_numbers(self):
+        draft = draft_document(BOOK, 3, "main.aux")
+        self.assertEqual(len(draft.splitlines()), len(BOOK.splitlines()))
+        lines = draft.splitlines()
+        self.assertEqual(lines[3], "See \\ref{two}.")
+        self.assertEqual(lines[5], "")
+
+    def test_aux_name_with_special_characters(self):
+        name = "my thesis_v2~%#.aux"
+        draft = draft_document(BOOK, 3, name)
+        line = draft.splitlines()[1]
+        self.assertIn("\\InputIfFileExists{" + tex_file_name(name) + "}", line)
+        # Nothing after \begin{document} may start a comment.
+        self.assertNotIn("%", line)
+
+    def test_labels_not_defined_twice(self):
+        line = draft_document(BOOK, 3, "main.aux").splitlines()[1]
+        self.assertIn("\\@ifundefined{#1@#2}", line)
+
+    def test_include(self):
+        draft = draft_document(BOOK, 6, "main.aux")
+        line = draft.splitlines()[1]
+        self.assertTrue(line.startswith("\\begin{document}"))
+        self.assertIn("\\edef\\@partlist{\\zap@space three \\@empty}", line)
+
+    def test_same_preamble(self):
+        for line in (3, 6):
+            draft = draft_document(BOOK, line, "main.aux")
+            self.assertEqual(get_preamble(draft), get_preamble(BOOK))
+
+    def test_outside_document(self):
+        self.assertIsNone(draft_document(BOOK, 0, "main.aux"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import tempfile
+import unittest
+
+from texwriter.fingerprint import InputFingerprint, parse_fls
+
+FLS = """PWD /home/user/thesis
+INPUT /usr/share/texmf/tex/latex/base/article.cls
+INPUT main.tex
+INPUT ./chapter.tex
+INPUT main.aux
+OUTPUT main.aux
+INPUT main.tex
+OUTPUT main.pdf
+"""
+
+
+class ParseFlsTest(unittest.TestCase):
+
+    def test_inputs(self):
+        self.assertEqual(parse_fls(FLS),
+                         ["/usr/share/texmf/tex/latex/base/article.cls",
+                          "/home/user/thesis/main.tex",
+                          "/home/user/thesis/chapter.tex"])
+
+
+class InputFingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "main.tex")
+        self.write("Hello")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, text, mtime=0):
+        with open(self.path, "w") as f:
+            f.write(text)
+        os.utime(self.path, (mtime, mtime))
+
+    def test_unchanged(self):
+        fingerprint = InputFingerprint([self.path, "/nonexistent/x.sty"])
+        self.assertEqual(list(fingerprint.files), [self.path])
+        self.assertFalse(fingerprint.changed())
+
+    def test_touched(self):
+        fingerprint = InputFingerprint([self.path])
+        self.write("Hello", mtime=1)
+        self.assertFalse(fingerprint.changed())
+
+    def test_same_size(self):
+        fingerprint = InputFingerprint([self.path])
+        self.write("Hallo", mtime=1)
+        self.assertTrue(fingerprint.changed())
+
+    def test_removed(self):
+        fingerprint = InputFingerprint([self.path])
+        os.remove(self.path)
+        self.assertTrue(fingerprint.changed())
+
+    def test_from_fls(self):
+        fls_path = os.path.join(self.tmp.name, "main.fls")
+        with open(fls_path, "w") as f:
+            f.write(f"PWD {self.tmp.name}\nINPUT main.tex\n")
+        fingerprint = InputFingerprint.from_fls(fls_path)
+        self.assertEqual(list(fingerprint.files), [self.path])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+
+from texwriter.logparser import BADBOX, ERROR, WARNING, LogEntry, parse_log
+
+UNDEFINED = """! Undefined control sequence.
+l.5 \\foo
+        
+"""
+
+LATEX_ERROR = """! LaTeX Error: Environment foo undefined.
+
+See the LaTeX manual or LaTeX Companion for explanation.
+Type  H <return>  for immediate help.
+ ...                                              
+                                                  
+l.7 \\begin{foo}
+               
+"""
+
+EMERGENCY_STOP = """! Emergency stop.
+<*> main.tex
+            
+*** (job aborted, no legal \\end found)
+
+"""
+
+WARNING_LINE = ("LaTeX Warning: Reference `sec:x' on page 1 undefined on input "
+                "line 9.\n")
+BADBOX_LINE = "Overfull \\hbox (1.0pt too wide) in paragraph at lines 11--12\n"
+
+
+class ParseLogTest(unittest.TestCase):
+
+    def test_error_with_line(self):
+        self.assertEqual(parse_log(UNDEFINED),
+                         [LogEntry(ERROR, "Undefined control sequence. : \\foo",
+                                   5, "\\foo")])
+
+    def test_latex_error_help_text(self):
+        entries = parse_log(LATEX_ERROR)
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0].kind, ERROR)
+        self.assertEqual(entries[0].line, 7)
+
+    def test_error_without_line_at_end(self):
+        self.assertEqual(parse_log(EMERGENCY_STOP),
+                         [LogEntry(ERROR, "Emergency stop.", None, None)])
+
+    def test_error_without_line_keeps_following_entries(self):
+        entries = parse_log(EMERGENCY_STOP + WARNING_LINE + UNDEFINED)
+        self.assertEqual([(e.kind, e.line) for e in entries],
+                         [(ERROR, None), (WARNING, 9), (ERROR, 5)])
+
+    def test_error_ended_by_next_error(self):
+        log = "! I can't find file `foo'.\n! Emergency stop.\n" + UNDEFINED
+        entries = parse_log(log)
+        self.assertEqual([(e.kind, e.title, e.line) for e in entries][:2],
+                         [(ERROR, "I can't find file `foo'.", None),
+                          (ERROR, "Emergency stop.", None)])
+        self.assertEqual(entries[2].line, 5)
+
+    def test_error_ended_by_warning_and_badbox(self):
+        log = "! Fatal format file error; I'm stymied.\n" + BADBOX_LINE + WARNING_LINE
+        entries = parse_log(log)
+        self.assertEqual([(e.kind, e.line) for e in entries],
+                         [(ERROR, None), (BADBOX, 11), (WARNING, 9)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+
+from texwriter.pagecache import PageCache, get_tiles
+
+
+class GetTilesTest(unittest.TestCase):
+
+    def test_all_tiles(self):
+        self.assertEqual(get_tiles(150, 120, tile_size=100),
+                         [(0, 0, 100, 100), (100, 0, 50, 100),
+                          (0, 100, 100, 20), (100, 100, 50, 20)])
+
+    def test_visible_tiles(self):
+        self.assertEqual(get_tiles(300, 300, (120.5, 30, 50, 50), tile_size=100),
+                         [(100, 0, 100, 100)])
+        self.assertEqual(get_tiles(300, 300, (150, 150, 100, 10), tile_size=100),
+                         [(100, 100, 100, 100), (200, 100, 100, 100)])
+
+    def test_outside(self):
+        self.assertEqual(get_tiles(300, 300, (400, 0, 50, 50), tile_size=100), [])
+
+
+class PageCacheTest(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = PageCache(3)
+        cache.put("a", 1, 1)
+        cache.put("b", 2, 1)
+        cache.put("c", 3, 1)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("d", 4, 1)
+        self.assertNotIn("b", cache)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.size, 3)
+
+    def test_replace(self):
+        cache = PageCache(10)
+        cache.put("a", 1, 4)
+        cache.put("a", 2, 3)
+        self.assertEqual(cache.get("a"), 2)
+        self.assertEqual(cache.size, 3)
+
+    def test_remove_and_budget(self):
+        cache = PageCache(10)
+        cache.put("a", 1, 4)
+        cache.put("b", 2, 4)
+        cache.remove("a")
+        cache.remove("x")
+        self.assertEqual(cache.size, 4)
+        cache.put("c", 3, 4)
+        cache.set_budget(5)
+        self.assertEqual(list(cache.entries), ["c"])
+        self.assertIsNone(cache.get("b"))
+
+    def test_too_large(self):
+        cache = PageCache(2)
+        cache.put("a", 1, 3)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
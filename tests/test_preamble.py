@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+
+from texwriter.preamble import format_name, get_preamble, prune_formats
+
+
+class GetPreambleTest(unittest.TestCase):
+
+    def test_preamble(self):
+        text = "\\documentclass{article}\n\\begin{document}\nText\n"
+        self.assertEqual(get_preamble(text),
+                         "\\documentclass{article}\n\\begin{document}")
+
+    def test_no_document(self):
+        self.assertIsNone(get_preamble("\\documentclass{article}\n"))
+
+    def test_commented_out(self):
+        text = "% \\begin{document}\n\\begin {document}\n"
+        self.assertEqual(get_preamble(text), text[:-1])
+
+
+class FormatNameTest(unittest.TestCase):
+
+    def test_depends_on_preamble_and_directory(self):
+        name = format_name("\\documentclass{article}", "/a")
+        self.assertTrue(name.startswith("preamble-"))
+        self.assertEqual(name, format_name("\\documentclass{article}", "/a"))
+        self.assertNotEqual(name, format_name("\\documentclass{book}", "/a"))
+        self.assertNotEqual(name, format_name("\\documentclass{article}", "/b"))
+
+
+class PruneFormatsTest(unittest.TestCase):
+
+    def test_keeps_most_recently_used(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for i in range(4):
+                for ext in (".fmt", ".log"):
+                    path = os.path.join(tmp, f"preamble-{i}{ext}")
+                    open(path, "w").close()
+                    os.utime(path, (i, i))
+            open(os.path.join(tmp, "other.fmt"), "w").close()
+            prune_formats(tmp, keep=2)
+            self.assertEqual(sorted(os.listdir(tmp)),
+                             ["other.fmt", "preamble-2.fmt", "preamble-2.log",
+                              "preamble-3.fmt", "preamble-3.log"])
+
+    def test_missing_directory(self):
+        prune_formats("/nonexistent/formats")
+
+
+if __name__ == "__main__":
+    unittest.main()
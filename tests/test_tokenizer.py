@@ -0,0 +1,82 @@
+import random
+import unittest
+
+from texwriter.tokenizer import (COMMAND, COMMENT, INLINE_MATH, LABEL, MATH,
+                                 NEWLINE, PACKAGE, TEXT, group_spans, tokenize)
+
+
+def spans(tokens, offset=0):
+    return [(kind, start + offset, end + offset) for kind, start, end
+            in zip(tokens.kinds, tokens.starts, tokens.ends)]
+
+
+class TokenizeTest(unittest.TestCase):
+
+    def test_commands_and_comment(self):
+        tokens = tokenize("\\emph{a} \\\\ 50\\% % note\n")
+        self.assertEqual(spans(tokens), [(COMMAND, 0, 5), (NEWLINE, 9, 11),
+                                         (COMMENT, 17, 23)])
+
+    def test_inline_math(self):
+        tokens = tokenize("a $x$ $$y$$ b\n")
+        self.assertEqual(spans(tokens), [(MATH, 2, 5)])
+
+    def test_math_across_lines(self):
+        tokens = tokenize("$a\nb$ c\n")
+        self.assertEqual(spans(tokens), [(MATH, 0, 2), (MATH, 3, 5)])
+        self.assertEqual(list(tokens.line_states), [TEXT, INLINE_MATH, TEXT])
+
+    def test_blank_line_ends_math(self):
+        tokens = tokenize("$a\n\nb\n")
+        self.assertEqual(list(tokens.line_states),
+                         [TEXT, INLINE_MATH, TEXT, TEXT])
+
+    def test_comment_ends_math(self):
+        tokens = tokenize("$a % b$\n")
+        self.assertEqual(spans(tokens), [(MATH, 0, 3), (COMMENT, 3, 7)])
+        self.assertEqual(tokens.line_states[1], INLINE_MATH)
+
+    def test_line_ends(self):
+        tokens = tokenize("a\r\nb\rc\nd")
+        self.assertEqual(list(tokens.line_offsets), [0, 3, 5, 7])
+
+    def test_symbols(self):
+        text = ("\\documentclass[a4paper]{article}\n"
+                "\\usepackage{amsmath, graphicx}\n"
+                "\\label{sec:intro} \\label{}\n")
+        self.assertEqual(tokenize(text).symbols,
+                         [(0, PACKAGE, "article"), (1, PACKAGE, "amsmath"),
+                          (1, PACKAGE, "graphicx"), (2, LABEL, "sec:intro")])
+
+    def test_resume_from_line_state(self):
+        # The parser re-lexes from the state stored at the start of a line,
+        # which must give the same tokens as lexing the whole text.
+        pieces = ["a", "$", "\\x", "%c", "\\\\", "\\$", " ", "\n", "\n\n",
+                  "\\label{l}"]
+        rng = random.Random(0)
+        for _ in range(200):
+            text = "".join(rng.choice(pieces) for _ in range(40))
+            tokens = tokenize(text)
+            for line, offset in enumerate(tokens.line_offsets):
+                rest = tokenize(text[offset:], tokens.line_states[line])
+                self.assertEqual(list(rest.line_states),
+                                 list(tokens.line_states[line:]))
+                self.assertEqual(spans(rest, offset),
+                                 [s for s in spans(tokens) if s[1] >= offset])
+
+
+class GroupSpansTest(unittest.TestCase):
+
+    def test_merges_adjacent_spans(self):
+        tokens = tokenize("\\a\\b % c\n\\d")
+        groups = group_spans(tokens)
+        self.assertEqual(list(groups[COMMAND]), [0, 4, 9, 11])
+        self.assertEqual(list(groups[COMMENT]), [5, 8])
+
+    def test_range(self):
+        tokens = tokenize("\\a\n\\b\n\\c")
+        self.assertEqual(list(group_spans(tokens, 1, 2)[COMMAND]), [3, 5])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,7 +2,215 @@ from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import Gio
 from gi.repository import GObject
-import xml.etree.ElementTree as ET
+from gi.repository import GLib
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from .completion import CompletionIndex, CompletionRanker, merge_commands
+from .completion import parse_completion_xml, read_cache, write_cache, write_json
+from .tokenizer import REFERENCE_COMMAND
+
+logger = logging.getLogger("Texwriter")
+
+RESOURCE_PATH = "/com/github/molnarandris/texwriter/completion/"
+
+# Packages whose commands are always offered.
+BASE_PACKAGES = ("tex", "latex-document")
+
+# Packages loaded by other packages.
+IMPLIED_PACKAGES = {
+    "amsmath": ("amsbsy", "amsopn"),
+    "amssymb": ("amsfonts",),
+    "xcolor": ("color",),
+}
+
+# Number of package combinations whose commands are kept in memory.
+MAX_PACKAGE_SETS = 8
+
+# Number of completions shown.
+MAX_RESULTS = 50
+
+# Commands taking a label as argument, completed when { is typed after them.
+REFERENCE_RE = re.compile(REFERENCE_COMMAND + "$")
+
+
+class CompletionDatabase:
+    """Completion commands, shared by all editors of the process.
+
+    Packages are loaded at their first use, in a worker thread if requested
+    through load_async. Only the MAX_PACKAGE_SETS package sets used last are
+    kept, and packages are unloaded with the last set using them. The parsed
+    commands are cached on disk, keyed by the digest of the package file, so
+    the XML only has to be parsed again when the file changes.
+
+    It also counts how often each command was chosen, and saves the counts
+    for the next sessions, so that completions can be ranked by usage.
+    """
+
+    default = None
+
+    @classmethod
+    def get_default(cls):
+        if cls.default is None:
+            cls.default = cls()
+        return cls.default
+
+    def __init__(self):
+        self.packages = {}
+        self.indices = OrderedDict()
+        self.items = {}
+        self.rankers = {}
+        self.usage_path = os.path.join(GLib.get_user_data_dir(),
+                                       "texwriter", "completion-usage.json")
+        self.usage = self.load_usage()
+        self.save_usage_id = 0
+        self.cache_dir = os.path.join(GLib.get_user_cache_dir(),
+                                      "texwriter", "completion")
+        try:
+            names = Gio.resources_enumerate_children(RESOURCE_PATH,
+                                                     Gio.ResourceLookupFlags.NONE)
+        except GLib.Error:
+            names = []
+        self.available = frozenset(name[:-4] for name in names
+                                   if name.endswith(".xml"))
+
+    def resolve_packages(self, packages):
+        """Return the completion packages to offer for a document that loads
+        `packages`, in a canonical order.
+        """
+        names = set()
+        for pkg in packages:
+            names.add(pkg)
+            names.update(IMPLIED_PACKAGES.get(pkg, ()))
+        names.difference_update(BASE_PACKAGES)
+        return BASE_PACKAGES + tuple(sorted(names & self.available))
+
+    def get_package(self, pkg):
+        if pkg not in self.packages:
+            self.packages[pkg] = self.load_package(pkg)
+        return self.packages[pkg]
+
+    def load_package(self, pkg):
+        try:
+            data = Gio.resources_lookup_data(RESOURCE_PATH + pkg + ".xml",
+                                             Gio.ResourceLookupFlags.NONE)
+        except GLib.Error as err:
+            logger.warning("Unable to load completion package %s: %s",
+                           pkg, err.message)
+            return []
+        data = data.get_data()
+        digest = hashlib.sha1(data).hexdigest()
+        path = os.path.join(self.cache_dir, pkg + ".json")
+        commands = read_cache(path, digest)
+        if commands is None:
+            commands = parse_completion_xml(data.decode('utf-8'), pkg)
+            try:
+                write_cache(path, digest, commands)
+            except OSError as err:
+                logger.warning("Unable to cache completion package %s: %s",
+                               pkg, err)
+        return commands
+
+    def get_commands(self, packages):
+        """Return the commands of `packages` and their index."""
+        key = tuple(packages)
+        if key not in self.indices:
+            commands = merge_commands(self.get_package(pkg) for pkg in key)
+            index = CompletionIndex(cmd['text'] for cmd in commands)
+            self.add_commands(key, commands, index)
+        self.indices.move_to_end(key)
+        return self.indices[key]
+
+    def add_commands(self, key, commands, index):
+        self.indices[key] = (commands, index)
+        # Forget the package sets that were not used for the longest time.
+        while len(self.indices) > MAX_PACKAGE_SETS:
+            old_key, _value = self.indices.popitem(last=False)
+            self.items.pop(old_key, None)
+            self.rankers.pop(old_key, None)
+            # Unload the packages that no remaining set uses.
+            used = set().union(*self.indices)
+            for pkg in [pkg for pkg in old_key if pkg not in used]:
+                self.packages.pop(pkg, None)
+
+    def load_async(self, packages, callback):
+        """Load the commands of `packages` in a worker thread, then call
+        `callback` with the tuple of packages from the main loop.
+        """
+        key = tuple(packages)
+        if key in self.indices:
+            callback(key)
+            return
+        loaded = {pkg: self.packages[pkg] for pkg in key if pkg in self.packages}
+        def worker():
+            for pkg in key:
+                if pkg not in loaded:
+                    loaded[pkg] = self.load_package(pkg)
+            commands = merge_commands(loaded[pkg] for pkg in key)
+            index = CompletionIndex(cmd['text'] for cmd in commands)
+            GLib.idle_add(self.load_done, key, loaded, commands, index, callback)
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+
+    def load_done(self, key, loaded, commands, index, callback):
+        self.packages.update(loaded)
+        if key not in self.indices:
+            self.add_commands(key, commands, index)
+        callback(key)
+        return False
+
+    def get_items(self, packages):
+        """Return the CompletionItems for the commands of `packages`."""
+        key = tuple(packages)
+        if key not in self.items:
+            commands, _index = self.get_commands(key)
+            self.items[key] = [CompletionItem(cmd) for cmd in commands]
+        return self.items[key]
+
+    def get_ranker(self, packages):
+        key = tuple(packages)
+        if key not in self.rankers:
+            commands, index = self.get_commands(key)
+            lowpriority = [cmd['lowpriority'] for cmd in commands]
+            self.rankers[key] = CompletionRanker(index, lowpriority, self.usage)
+        return self.rankers[key]
+
+    def load_usage(self):
+        try:
+            with open(self.usage_path, encoding="utf-8") as f:
+                usage = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return usage if isinstance(usage, dict) else {}
+
+    def record_use(self, text):
+        """Count that the completion with `text` was chosen."""
+        self.usage[text] = self.usage.get(text, 0) + 1
+        for ranker in self.rankers.values():
+            ranker.reset()
+        if self.save_usage_id == 0:
+            self.save_usage_id = GLib.timeout_add_seconds(5, self.save_usage)
+
+    def save_usage(self):
+        self.save_usage_id = 0
+        try:
+            write_json(self.usage_path, self.usage)
+        except OSError as err:
+            logger.warning("Unable to save completion usage: %s", err)
+        return False
+
+
+class CompletionItem(GObject.Object):
+    __gtype_name__ = 'CompletionItem'
+
+    def __init__(self, cmd):
+        super().__init__()
+        self.text = cmd['text']
+        self.command = cmd['command']
 
 
 class AutocompletePopover(Gtk.Popover):
@@ -13,17 +221,26 @@ class AutocompletePopover(Gtk.Popover):
         self.set_parent(textview)
         self.set_autohide(True)
         self.is_active = False
-        listbox = Gtk.ListBox()
-        listbox.set_selection_mode(Gtk.SelectionMode.BROWSE)
+
+        # Only the best completions are put in the list, and only the rows
+        # that are visible are created by the list view, so the number of
+        # widgets does not depend on the number of commands.
+        self.results = Gio.ListStore.new(CompletionItem)
+        self.selection = Gtk.SingleSelection.new(self.results)
+        factory = Gtk.SignalListItemFactory()
+        factory.connect("setup", self.setup_item_cb)
+        factory.connect("bind", self.bind_item_cb)
+        listview = Gtk.ListView.new(self.selection, factory)
+        listview.set_single_click_activate(True)
         scroll = Gtk.ScrolledWindow()
-        scroll.set_child(listbox)
+        scroll.set_child(listview)
         scroll.set_propagate_natural_width(True)
+        scroll.set_max_content_height(300)
         scroll.set_propagate_natural_height(True)
         self.set_child(scroll)
-        self.commands = []
         self.textview = textview
 
-        listbox.connect("row-activated", self.row_activated_cb)
+        listview.connect("activate", self.item_activated_cb)
 
         controller = Gtk.EventControllerKey()
         controller.set_propagation_phase(Gtk.PropagationPhase.BUBBLE)
@@ -38,41 +255,37 @@ class AutocompletePopover(Gtk.Popover):
 
         self.connect("closed", self.closed_cb)
 
-        self.listbox = listbox
+        self.listview = listview
 
-        packages = ["tex", "latex-document", "amsmath", "amsthm"]
-        for pkg in packages:
-            file = Gio.File.new_for_uri(f"resource:///com/github/molnarandris/texwriter/completion/{pkg}.xml")
-            contents = file.load_contents()
-            text = contents[1].decode('utf-8')
-            root = ET.fromstring(text)
-            for child in root:
-                if child.tag == "command":
-                    a = child.attrib
-                    cmd = {'package': pkg,
-                           'command': a['text'],
-                           'text': a['name'],
-                           'description': _(a['description']),
-                           'lowpriority': True if a['lowpriority'] == "True" else False,
-                           'dotlabels': a['dotlabels']}
-                    self.commands.append(cmd)
-                if child.tag == "environment":
-                    a = child.attrib
-                    cmd = {'package': pkg,
-                           'command': "\\begin{" + a['text'] + "}\n\\end{"+ a['text'] +"}",
-                           'text': "\\begin{" + a['name'] + "}...\\end{"+ a['name'] +"}",
-                           'description': _(a['description']),
-                           'lowpriority': True if a['lowpriority'] == "True" else False,
-                           'dotlabels': a['dotlabels']}
-                    self.commands.append(cmd)
-
-        for cmd in self.commands:
-            if cmd['lowpriority'] is False:
-                self.create_row(cmd)
-
-        for cmd in self.commands:
-            if cmd['lowpriority'] is True:
-                self.create_row(cmd)
+        self.packages = BASE_PACKAGES
+        # The commands are only set up at the first activation, so that
+        # opening an editor costs nothing.
+        self.ranker = None
+        self.items = []
+        # The LabelIndex of the document, for completing references.
+        self.labels = None
+        self.complete_labels = False
+
+    def set_packages(self, packages):
+        """Offer the commands of the packages loaded by the document."""
+        database = CompletionDatabase.get_default()
+        key = database.resolve_packages(packages)
+        if key == self.packages:
+            return
+        self.packages = key
+        database.load_async(key, self.packages_loaded_cb)
+
+    def packages_loaded_cb(self, key):
+        # Before the first activation there is nothing to update.
+        if key == self.packages and self.ranker is not None:
+            self.load_commands()
+
+    def load_commands(self):
+        database = CompletionDatabase.get_default()
+        self.items = database.get_items(self.packages)
+        self.ranker = database.get_ranker(self.packages)
+        if self.is_active:
+            self.update_matches()
 
     def closed_cb(self, user_data):
         buffer = self.textview.get_buffer()
@@ -80,19 +293,33 @@ class AutocompletePopover(Gtk.Popover):
         mark is not None and buffer.delete_mark(mark)
         self.is_active = False
 
-    def create_row(self, cmd):
-        row = Gtk.ListBoxRow()
-        row.set_halign(Gtk.Align.START)
-        row.text = cmd['text']
-        row.command = cmd['command']
-        row.set_child(Gtk.Label.new(row.text))
-        self.listbox.append(row)
+    def setup_item_cb(self, factory, list_item):
+        label = Gtk.Label()
+        label.set_halign(Gtk.Align.START)
+        list_item.set_child(label)
+
+    def bind_item_cb(self, factory, list_item):
+        list_item.get_child().set_label(list_item.get_item().text)
 
     def textview_key_press_cb(self, controller, keyval, keycode, state):
-        if not self.is_active and keyval == Gdk.KEY_backslash:
+        if self.is_active:
+            return Gdk.EVENT_PROPAGATE
+        if keyval == Gdk.KEY_backslash:
             self.activate()
+        elif keyval == Gdk.KEY_braceleft and self.after_reference_command():
+            self.activate(complete_labels=True)
         return Gdk.EVENT_PROPAGATE
 
+    def after_reference_command(self):
+        if self.labels is None:
+            return False
+        buffer = self.textview.get_buffer()
+        end_it = buffer.get_iter_at_mark(buffer.get_insert())
+        start_it = end_it.copy()
+        start_it.set_line_offset(0)
+        text = buffer.get_text(start_it, end_it, False)
+        return REFERENCE_RE.search(text) is not None
+
     def key_press_cb(self, controller, keyval, keycode, state):
         if not self.is_active and keyval != Gdk.KEY_backslash:
             return Gdk.EVENT_PROPAGATE
@@ -100,53 +327,65 @@ class AutocompletePopover(Gtk.Popover):
             case Gdk.KEY_Escape:
                 self.popdown()
             case Gdk.KEY_Tab | Gdk.KEY_Return:
-                row = self.listbox.get_selected_row()
-                row.emit("activate")
+                item = self.selection.get_selected_item()
+                item is not None and self.insert_item(item)
+                return Gdk.EVENT_STOP
+            case Gdk.KEY_Up | Gdk.KEY_Down:
+                n_items = self.results.get_n_items()
+                step = -1 if keyval == Gdk.KEY_Up else 1
+                position = self.selection.get_selected() + step
+                if 0 <= position < n_items:
+                    self.select(position)
                 return Gdk.EVENT_STOP
             case _:
-                if controller.forward(self.listbox):
-                    return Gdk.EVENT_STOP
+                controller.forward(self.textview)
+                self.update_matches()
+                self.update_position()
+                if self.results.get_n_items() == 0:
+                    self.popdown()
                 else:
-                    controller.forward(self.textview)
-                    self.listbox.invalidate_filter()
-                    self.update_position()
-                    idx = 0
-                    row = self.listbox.get_row_at_index(idx)
-                    while not self.filter_func(row):
-                        idx += 1
-                        row = self.listbox.get_row_at_index(idx)
-                        if row is None:
-                            break
-                    self.listbox.select_row(row)
-                    if row is None:
-                        self.popdown()
-                    else:
-                        row.grab_focus()
-                    return Gdk.EVENT_STOP
+                    self.select(0)
+                return Gdk.EVENT_STOP
         return Gdk.EVENT_PROPAGATE
 
     def key_release_cb(self, controller, keyval, keycode, state):
         if not self.is_active and keyval != Gdk.KEY_backslash:
             return
-        controller.forward(self.listbox)
+        controller.forward(self.listview)
 
-    def activate(self):
+    def select(self, position):
+        flags = Gtk.ListScrollFlags.FOCUS | Gtk.ListScrollFlags.SELECT
+        self.listview.scroll_to(position, flags, None)
+
+    def activate(self, complete_labels=False):
+        self.complete_labels = complete_labels
+        if complete_labels:
+            if not self.labels.names:
+                return
+        elif self.ranker is None:
+            self.load_commands()
         mark = Gtk.TextMark.new("autocomplete", left_gravity=True)
         buffer = self.get_parent().get_buffer()
         it = buffer.get_iter_at_mark(buffer.get_insert())
         buffer.add_mark(mark, it)
-        self.listbox.set_filter_func(self.filter_func)
+        self.update_matches()
         self.update_position()
         self.popup()
-        row = self.listbox.get_row_at_index(0)
-        self.listbox.select_row(row)
-        row.grab_focus()
+        self.select(0)
         self.is_active = True
 
-    def row_activated_cb(self, listbox, row):
+    def item_activated_cb(self, listview, position):
+        self.insert_item(self.results.get_item(position))
+
+    def insert_item(self, item):
         buffer = self.textview.get_buffer()
         text = self.get_typed_text()
-        buffer.insert_at_cursor(row.command.lstrip(text))
+        if self.complete_labels:
+            # The typed text starts with the opening brace.
+            buffer.insert_at_cursor(item.command[len(text)-1:])
+        else:
+            buffer.insert_at_cursor(item.command.lstrip(text))
+            CompletionDatabase.get_default().record_use(item.text)
         self.popdown()
 
     def get_typed_text(self):
@@ -157,11 +396,16 @@ class AutocompletePopover(Gtk.Popover):
         text = buffer.get_text(start_it, end_it, include_hidden_chars=False)
         return text
 
-    def filter_func(self, row):
-        if row is None:
-            return False
+    def update_matches(self):
         text = self.get_typed_text()
-        return row.text.find(text) != -1
+        if self.complete_labels:
+            names = self.labels.complete(text[1:], MAX_RESULTS)
+            items = [CompletionItem({'text': name, 'command': name + "}"})
+                     for name in names]
+        else:
+            ranked = self.ranker.rank(text, MAX_RESULTS)
+            items = [self.items[i] for i in ranked]
+        self.results.splice(0, self.results.get_n_items(), items)
 
     def button_release_cb(self, window, n, x, y):
         self.is_active and self.deactivate()
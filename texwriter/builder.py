@@ -0,0 +1,342 @@
+import hashlib
+import logging
+import os
+import shlex
+import shutil
+import signal
+from gi.repository import GLib
+from gi.repository import Gio
+from gi.repository import GObject
+
+logger = logging.getLogger("Texwriter")
+
+APP_ID = "com.github.molnarandris.texwriter"
+
+# Printed by the worker after each command, followed by its exit status.
+SENTINEL = "@@texwriter-build-done@@"
+
+# The worker runs each line it reads as a command, then reports its status.
+# When its standard input is closed, i.e. when TeXWriter exits, it exits.
+WORKER_SCRIPT = ('while IFS= read -r line; do eval "$line"; '
+                 'printf "\\n%s %s\\n" "' + SENTINEL + '" "$?"; done')
+
+# Seconds to wait for a terminated worker to exit before killing
+# flatpak-spawn, which leaves the worker running on the host.
+STOP_TIMEOUT = 10
+
+
+def get_build_directory(source_dir, base=""):
+    """Return the build directory of the documents in `source_dir`.
+
+    Build directories are created in `base`. If it is empty, they are
+    created in the runtime directory of the application, which is usually
+    in memory and is visible from the host at the same path. If it is ".",
+    the sources are built in place.
+    """
+    if base == ".":
+        return source_dir
+    if not base:
+        base = os.path.join(GLib.get_user_runtime_dir(), "app", APP_ID, "build")
+    digest = hashlib.sha1(source_dir.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(base, os.path.basename(source_dir) + "-" + digest)
+
+
+def copy_outputs(build_dir, source_dir, stem, extensions):
+    """Copy the outputs `stem`.`ext` from `build_dir` to `source_dir`.
+
+    Each file is replaced atomically, so other programs never see a partial
+    file. This is blocking and is meant to run in a worker thread.
+    """
+    for ext in extensions:
+        name = stem + "." + ext
+        tmp_path = os.path.join(source_dir, "." + name + ".tmp")
+        try:
+            shutil.copyfile(os.path.join(build_dir, name), tmp_path)
+            os.replace(tmp_path, os.path.join(source_dir, name))
+        except OSError as err:
+            logger.warning("Unable to copy %s to %s: %s", name, source_dir,
+                           err.strerror)
+
+
+class LatexmkBuilder(GObject.Object):
+    """Runs the builds of one document in a long-lived worker on the host.
+
+    Spawning a process on the host through flatpak-spawn is slow, so a shell
+    is spawned once, and every build request is sent to it as a command line.
+    The worker is spawned again if it exits or a build is cancelled.
+
+    Stopping a build terminates the worker with SIGTERM, which flatpak-spawn
+    forwards to the process group of the worker on the host, so latexmk and
+    LaTeX are terminated too. The build is only reported cancelled, and the
+    next build only started, once the worker has exited.
+
+    The output of the running build is emitted line by line as it arrives.
+    """
+    __gtype_name__ = 'LatexmkBuilder'
+
+    __gsignals__ = {
+        'output': (GObject.SignalFlags.RUN_FIRST, None, (str,)),
+    }
+
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+        self.proc = None
+        self.stdout = None
+        self.task = None
+        # The workers being terminated.
+        self.stopping = set()
+        # The (task, line) of a build waiting for the workers to exit.
+        self.queued = None
+
+    def spawn_worker(self):
+        # With --watch-bus, the worker is also terminated if TeXWriter dies.
+        cmd = ['flatpak-spawn', '--host', '--watch-bus',
+               '--directory=' + self.directory, 'sh', '-c', WORKER_SCRIPT]
+        flags = Gio.SubprocessFlags.STDIN_PIPE
+        flags = flags | Gio.SubprocessFlags.STDOUT_PIPE
+        flags = flags | Gio.SubprocessFlags.STDERR_MERGE
+        self.proc = Gio.Subprocess.new(cmd, flags)
+        self.stdout = Gio.DataInputStream.new(self.proc.get_stdout_pipe())
+        self.stdout.read_line_async(GLib.PRIORITY_DEFAULT, None,
+                                    self.read_line_cb, self.proc)
+
+    def stop(self):
+        """Terminate the worker, failing the running build if there is one
+        once the worker has exited."""
+        if self.queued is not None:
+            task, _line = self.queued
+            self.queued = None
+            self.return_cancelled(task)
+        task = self.task
+        self.task = None
+        proc = self.proc
+        self.proc = None
+        self.stdout = None
+        if proc is None:
+            if task is not None:
+                self.return_cancelled(task)
+            return
+        self.stopping.add(proc)
+        proc.send_signal(signal.SIGTERM)
+        proc.wait_async(None, self.worker_exited, task)
+        GLib.timeout_add_seconds(STOP_TIMEOUT, self.stop_timeout, proc)
+
+    def stop_timeout(self, proc):
+        if proc in self.stopping:
+            logger.warning("The build worker did not exit, killing it")
+            proc.force_exit()
+        return False
+
+    def worker_exited(self, proc, result, task):
+        try:
+            proc.wait_finish(result)
+        except GLib.Error as err:
+            logger.warning("Unable to wait for the build worker: %s", err.message)
+        self.stopping.discard(proc)
+        if task is not None:
+            self.return_cancelled(task)
+        if not self.stopping and self.queued is not None:
+            task, line = self.queued
+            self.queued = None
+            self.run(task, line)
+
+    def build_async(self, cmd, cancellable, callback, user_data=None):
+        """Run the command line `cmd` in the worker.
+
+        Cancelling `cancellable` stops the build."""
+        if self.task is not None:
+            # A build is still running. The worker has to be restarted to
+            # stop it.
+            self.stop()
+        cancellable = cancellable or Gio.Cancellable()
+
+        original_callback = callback
+        def callback(source_object, result, not_user_data):
+            original_callback(source_object, result, user_data)
+
+        task = Gio.Task.new(self, cancellable, callback, user_data)
+        if cancellable.is_cancelled():
+            self.return_cancelled(task)
+            return
+        # Gio.Cancellable.connect() is g_cancellable_connect(), not the
+        # signal.
+        task.cancel_id = GObject.Object.connect(cancellable, "cancelled",
+                                                self.on_cancelled, task)
+
+        line = shlex.join(cmd) + "\n"
+        if self.stopping:
+            # Wait for the previous build to stop, as both would write the
+            # same outputs.
+            self.queued = (task, line)
+        else:
+            self.run(task, line)
+
+    def on_cancelled(self, cancellable, task):
+        if task is self.task or (self.queued is not None and self.queued[0] is task):
+            self.stop()
+
+    def run(self, task, line):
+        self.task = task
+        try:
+            if self.proc is None:
+                self.spawn_worker()
+            cancellable = task.get_cancellable()
+            stdin = self.proc.get_stdin_pipe()
+            stdin.write_all(line.encode("utf-8"), cancellable)
+            stdin.flush(cancellable)
+        except GLib.Error as err:
+            self.task = None
+            self.stop()
+            self.return_task(task, err)
+
+    def read_line_cb(self, stdout, result, proc):
+        try:
+            line, _length = stdout.read_line_finish_utf8(result)
+        except GLib.Error as err:
+            line = None
+            logger.warning("Unable to read build output: %s", err.message)
+
+        if proc is not self.proc:
+            # The worker was stopped in the meantime.
+            return
+        if line is None:
+            # The worker has exited.
+            self.proc = None
+            self.stdout = None
+            self.finish_task(None)
+            return
+
+        if line.startswith(SENTINEL):
+            self.finish_task(line[len(SENTINEL):].strip() == "0")
+        elif self.task is not None:
+            self.emit("output", line)
+        stdout.read_line_async(GLib.PRIORITY_DEFAULT, None,
+                               self.read_line_cb, proc)
+
+    def finish_task(self, success):
+        """Complete the running build. `success` is None if the worker
+        exited before the build was done.
+        """
+        task = self.task
+        if task is None:
+            return
+        self.task = None
+        if success is None:
+            self.return_cancelled(task)
+        elif not success:
+            err = GLib.Error("Compilation failed",
+                             GLib.Spawn_error_quark(),
+                             GLib.SpawnErrorEnum.FAILED)
+            self.return_task(task, err)
+        else:
+            self.return_task(task)
+
+    def return_cancelled(self, task):
+        err = GLib.Error("The build was interrupted",
+                         Gio.io_error_quark(),
+                         Gio.IOErrorEnum.CANCELLED)
+        self.return_task(task, err)
+
+    def return_task(self, task, err=None):
+        """Return `err`, or success if it is None, from `task`."""
+        cancel_id = getattr(task, "cancel_id", None)
+        if cancel_id is not None:
+            GObject.signal_handler_disconnect(task.get_cancellable(), cancel_id)
+            task.cancel_id = None
+        if err is not None:
+            task.return_error(err)
+        else:
+            task.return_boolean(True)
+
+    def build_finish(self, result):
+        if not Gio.Task.is_valid(result, self):
+            err = GLib.Error("Compilation failed",
+                             GLib.Spawn_error_quark(),
+                             GLib.SpawnErrorEnum.FAILED)
+            raise err
+
+        return result.propagate_boolean()
+
+
+class BuildScheduler:
+    """Limits the number of builds running at the same time in the
+    application.
+
+    Builds are started through submit(), which runs them right away if fewer
+    than max_jobs are running, and queues them otherwise. Every document has
+    at most one queued build: submitting another replaces it. The build of
+    the focused document is started first, the others in the order they
+    were submitted.
+    """
+
+    default = None
+
+    @classmethod
+    def get_default(cls):
+        if cls.default is None:
+            cls.default = cls()
+        return cls.default
+
+    def __init__(self):
+        self.settings = Gio.Settings.new(APP_ID)
+        # Maps each document with a queued build to a (start, dropped) pair.
+        # Dicts keep insertion order, so this is also the queue.
+        self.queue = {}
+        self.running = set()
+        self.focused = None
+
+    @property
+    def max_jobs(self):
+        max_jobs = self.settings.get_int("max-builds")
+        if max_jobs <= 0:
+            # LaTeX runs on a single core. Leave one for the user interface.
+            max_jobs = max(1, (os.cpu_count() or 1) - 1)
+        return max_jobs
+
+    def submit(self, key, start, dropped=None):
+        """Call `start()` when a build of the document `key` can run.
+
+        `dropped()` is called instead if the build is replaced or cancelled
+        before it starts.
+        """
+        self.cancel(key)
+        self.queue[key] = (start, dropped)
+        self.run_next()
+
+    def cancel(self, key):
+        """Drop the queued build of `key`, if any."""
+        _start, dropped = self.queue.pop(key, (None, None))
+        if dropped is not None:
+            dropped()
+
+    def done(self, key):
+        """Tell that the build of `key` has finished."""
+        self.running.discard(key)
+        self.run_next()
+
+    def remove(self, key):
+        """Forget the document `key` when it is closed, dropping its queued
+        build. Its running build is no longer counted."""
+        self.cancel(key)
+        self.running.discard(key)
+        if self.focused is key:
+            self.focused = None
+        self.run_next()
+
+    def set_focused(self, key):
+        self.focused = key
+
+    def run_next(self):
+        starts = []
+        while self.queue and len(self.running) < self.max_jobs:
+            # A document is only built once at a time.
+            keys = [key for key in self.queue if key not in self.running]
+            if not keys:
+                break
+            key = self.focused if self.focused in keys else keys[0]
+            start, _dropped = self.queue.pop(key)
+            self.running.add(key)
+            starts.append(start)
+        for start in starts:
+            start()
@@ -0,0 +1,101 @@
+"""Timings of the stages of builds.
+
+A build goes through saving, compiling, loading the PDF and the log and
+SyncTeX. Every stage is timed with a monotonic clock.
+"""
+
+import json
+import time
+from collections import deque
+
+# Stage outcomes.
+SUCCESS = "success"
+FAILED = "failed"
+CANCELLED = "cancelled"
+# The outputs of the previous build were up to date.
+UP_TO_DATE = "up-to-date"
+
+# Number of builds kept in the history of a document.
+MAX_RECORDS = 100
+
+
+class BuildRecord:
+    """Timings and outcomes of the stages of one build."""
+
+    def __init__(self, document, draft=False):
+        self.document = document
+        self.draft = draft
+        # Wall clock time, only used for display.
+        self.started = time.time()
+        self.start = time.monotonic()
+        self.end_time = None
+        # Each stage is a [name, start, duration, outcome] list, with start
+        # relative to the start of the build. Duration and outcome are None
+        # while the stage is running.
+        self.stages = []
+
+    def begin(self, name):
+        self.stages.append([name, time.monotonic() - self.start, None, None])
+        self.end_time = None
+
+    def end(self, name, outcome=SUCCESS):
+        """End the last stage called `name`."""
+        now = time.monotonic() - self.start
+        for stage in reversed(self.stages):
+            if stage[0] == name and stage[2] is None:
+                stage[2] = now - stage[1]
+                stage[3] = outcome
+                break
+        if all(stage[2] is not None for stage in self.stages):
+            self.end_time = now
+
+    @property
+    def running(self):
+        return self.end_time is None
+
+    @property
+    def duration(self):
+        if self.end_time is not None:
+            return self.end_time
+        return time.monotonic() - self.start
+
+    @property
+    def outcome(self):
+        """The outcome of the first stage that did not succeed, or SUCCESS."""
+        for stage in self.stages:
+            if stage[3] not in (None, SUCCESS):
+                return stage[3]
+        return SUCCESS
+
+    def to_dict(self):
+        return {
+            "document": self.document,
+            "draft": self.draft,
+            "started": self.started,
+            "duration": self.duration,
+            "running": self.running,
+            "outcome": self.outcome,
+            "stages": [{"name": name, "start": start, "duration": duration,
+                        "outcome": outcome}
+                       for name, start, duration, outcome in self.stages],
+        }
+
+
+class BuildHistory:
+    """The most recent build records of a document, oldest first."""
+
+    def __init__(self, maxlen=MAX_RECORDS):
+        self.records = deque(maxlen=maxlen)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, record):
+        self.records.append(record)
+
+    def to_json(self):
+        return json.dumps([record.to_dict() for record in self.records],
+                          indent=2)
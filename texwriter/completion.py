@@ -0,0 +1,285 @@
+import heapq
+import json
+import math
+import os
+import xml.etree.ElementTree as ET
+from operator import itemgetter
+
+
+class CompletionIndex:
+    """Character index over the texts of completion entries.
+
+    Every character of every text is mapped to the indices of the texts
+    containing it, so the entries that can match a query as a subsequence
+    are found by intersecting the sets of its characters.
+
+    Short queries match most of the texts, so the fuzzy matches of every two
+    character query against the texts starting with its first character,
+    like a backslash and the first letter of a command, are computed in
+    advance.
+    """
+
+    def __init__(self, texts):
+        self.texts = list(texts)
+        self.all = frozenset(range(len(self.texts)))
+        self.none = frozenset()
+        chars = {}
+        firsts = {}
+        pairs = {}
+        for i, text in enumerate(self.texts):
+            for ch in set(text):
+                chars.setdefault(ch, []).append(i)
+            if not text:
+                continue
+            first = text[0]
+            firsts.setdefault(first, []).append(i)
+            # fuzzy_match() of the second character, inlined. The first one
+            # matched at 0, which scored 3.
+            for ch in set(text[1:]):
+                j = text.find(ch, 1)
+                if j == 1:
+                    score = 6
+                elif not text[j-1].isalpha():
+                    score = 5
+                else:
+                    score = 3 - min(j - 1, 3)
+                pair = first + ch
+                if pair in pairs:
+                    pairs[pair].append((i, score, j))
+                else:
+                    pairs[pair] = [(i, score, j)]
+        self.chars = {ch: frozenset(indices) for ch, indices in chars.items()}
+        self.firsts = {ch: frozenset(indices) for ch, indices in firsts.items()}
+        self.pairs = pairs
+
+    def search_chars(self, query):
+        """Return the set of indices of the texts containing every character
+        of `query`."""
+        chars = self.chars
+        matches = self.all
+        for ch in set(query):
+            matches = matches & chars.get(ch, self.none)
+        return matches
+
+    def match_pair(self, pair):
+        """Return the (index, score, pos) fuzzy matches of the two character
+        query `pair`, as given by fuzzy_match()."""
+        matches = self.pairs.get(pair, [])
+        others = self.search_chars(pair) - self.firsts.get(pair[0], self.none)
+        if others:
+            texts = self.texts
+            matches = matches + [(i, *match) for i in others
+                                 if (match := fuzzy_match(pair, texts[i]))]
+        return matches
+
+
+def parse_completion_xml(text, package):
+    """Parse a completion package file into a list of command dicts.
+
+    Descriptions are left untranslated.
+    """
+    commands = []
+    root = ET.fromstring(text)
+    for child in root:
+        if child.tag == "command":
+            a = child.attrib
+            cmd = {'package': package,
+                   'command': a['text'],
+                   'text': a['name'],
+                   'description': a['description'],
+                   'lowpriority': True if a['lowpriority'] == "True" else False,
+                   'dotlabels': a['dotlabels']}
+            commands.append(cmd)
+        if child.tag == "environment":
+            a = child.attrib
+            cmd = {'package': package,
+                   'command': "\\begin{" + a['text'] + "}\n\\end{"+ a['text'] +"}",
+                   'text': "\\begin{" + a['name'] + "}...\\end{"+ a['name'] +"}",
+                   'description': a['description'],
+                   'lowpriority': True if a['lowpriority'] == "True" else False,
+                   'dotlabels': a['dotlabels']}
+            commands.append(cmd)
+    return commands
+
+
+def merge_commands(packages):
+    """Concatenate the command lists in `packages`, dropping the commands
+    whose text already appeared in an earlier package."""
+    seen = set()
+    commands = []
+    for package in packages:
+        for cmd in package:
+            if cmd['text'] not in seen:
+                seen.add(cmd['text'])
+                commands.append(cmd)
+    return commands
+
+
+def read_cache(path, digest):
+    """Return the commands cached at `path`, or None if there are none for
+    the package file with the given digest.
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cache, dict) or cache.get("digest") != digest:
+        return None
+    return cache.get("commands")
+
+
+def write_cache(path, digest, commands):
+    write_json(path, {"digest": digest, "commands": commands})
+
+
+def write_json(path, data):
+    """Atomically replace the file at `path` by `data` encoded as JSON."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def fuzzy_match(query, text, score=0, pos=-1):
+    """Match `query` as a subsequence of the part of `text` after `pos`.
+
+    Returns the updated score and the position of the last character
+    matched, or None if `query` does not match. Matching the characters of a
+    query one by one gives the same result as matching it at once, so the
+    match of a query can be extended when it is typed further.
+    """
+    for ch in query:
+        i = text.find(ch, pos + 1)
+        if i < 0:
+            return None
+        if i == pos + 1:
+            score += 3
+        elif not text[i-1].isalpha():
+            score += 2
+        else:
+            score -= min(i - pos - 1, 3)
+        pos = i
+    return score, pos
+
+
+def fuzzy_score(query, text):
+    """Return how well `query` matches `text` as a subsequence, or None if it
+    does not match. Consecutive characters, characters at the start of a word
+    and a matching prefix score higher, gaps score lower.
+    """
+    match = fuzzy_match(query, text)
+    if match is None:
+        return None
+    score = match[0]
+    if text.startswith(query):
+        score += 5
+    # Prefer shorter texts among otherwise equal matches.
+    return score - 0.01 * len(text)
+
+
+class CompletionRanker:
+    """Ranks completion entries for a query.
+
+    The rank of an entry combines its fuzzy match score, its low priority
+    flag and how often the user has chosen it before. Only the best entries
+    are returned. When the query is extended, the matches of the previous
+    query are extended by the new characters instead of being matched again.
+    """
+
+    LOWPRIORITY_PENALTY = 4.0
+    USAGE_WEIGHT = 3.0
+
+    def __init__(self, index, lowpriority, usage):
+        self.index = index
+        self.texts = index.texts
+        self.lowpriority = lowpriority
+        self.usage = usage
+        self.positions = {text: i for i, text in enumerate(self.texts)}
+
+        self.last_query = None
+        # The (index, score, pos) fuzzy matches of the last query.
+        self.last_matches = None
+        # The results of queries that are typed again and again, like the
+        # backslash starting every command.
+        self.cache = {}
+        self.update_base_scores()
+
+    def update_base_scores(self):
+        """Compute the part of the rank of every entry that does not depend
+        on the query."""
+        texts = self.texts
+        penalty = self.LOWPRIORITY_PENALTY
+        self.base_scores = [-0.01 * len(text) - (penalty if low else 0.0)
+                            for text, low in zip(texts, self.lowpriority)]
+        # Only the entries chosen before have a usage count.
+        for text, count in self.usage.items():
+            i = self.positions.get(text)
+            if i is not None and count > 0:
+                self.base_scores[i] += self.USAGE_WEIGHT * math.log1p(count)
+
+    def rank(self, query, n):
+        """Return the indices of the `n` best entries for `query`, best
+        first."""
+        if (query, n) in self.cache:
+            result, self.last_matches = self.cache[query, n]
+            self.last_query = query
+            return result
+
+        texts = self.texts
+        last_query = self.last_query
+        if (last_query is not None and len(last_query) >= 2
+                and query.startswith(last_query)):
+            # Entries matching the extended query all match the previous one.
+            rest = query[len(last_query):]
+            matches = self.last_matches
+        elif len(query) >= 2:
+            # Looking up the matches of the first two characters costs less
+            # than extending those of a shorter query, which match almost
+            # every entry.
+            rest = query[2:]
+            matches = self.index.match_pair(query[:2])
+        else:
+            rest = query
+            matches = [(i, 0, -1) for i in self.index.search_chars(query)]
+        for ch in rest:
+            # fuzzy_match() inlined, as this runs for every candidate.
+            extended = []
+            append = extended.append
+            containing = self.index.chars.get(ch, ())
+            for i, score, pos in matches:
+                if i not in containing:
+                    continue
+                text = texts[i]
+                j = text.find(ch, pos + 1)
+                if j < 0:
+                    continue
+                if j == pos + 1:
+                    score += 3
+                elif not text[j-1].isalpha():
+                    score += 2
+                else:
+                    score -= min(j - pos - 1, 3)
+                append((i, score, j))
+            matches = extended
+
+        base_scores = self.base_scores
+        # The texts starting with the query are those where its last
+        # character matched at the end of the query.
+        end = len(query) - 1
+        scores = [(score + base_scores[i] + (5 if pos == end else 0), i)
+                  for i, score, pos in matches]
+        result = [i for _score, i in heapq.nlargest(n, scores, key=itemgetter(0))]
+        self.last_query = query
+        self.last_matches = matches
+        if len(query) <= 1:
+            self.cache[query, n] = (result, matches)
+        return result
+
+    def reset(self):
+        """Forget the previous queries, e.g. after the usage counts changed."""
+        self.last_query = None
+        self.last_matches = None
+        self.cache.clear()
+        self.update_base_scores()
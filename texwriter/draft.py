@@ -0,0 +1,136 @@
+"""Draft documents compiling only a part of a document.
+
+A draft keeps every line of the document at its place, so that SyncTeX line
+numbers in the draft are line numbers in the document. The lines outside of
+the compiled part are emptied.
+"""
+
+import re
+
+from .tokenizer import eol_re
+
+# Sectioning commands that delimit the compiled part, by level.
+SECTION_LEVELS = {"part": 0, "chapter": 1, "section": 2}
+
+begin_document_re = re.compile(r"^[^%\n]*?\\begin\s*\{document\}")
+end_document_re = re.compile(r"^[^%\n]*?\\end\s*\{document\}")
+section_re = re.compile(r"^[^%\n]*?\\(part|chapter|section)\*?\s*[\[{]")
+include_re = re.compile(r"^[^%\n]*?\\include\s*\{([^}]*)\}")
+# Characters of file names that cannot be written in \detokenize, with the
+# LaTeX code giving them.
+special_chars_re = re.compile(r"[%#\\{}]")
+SPECIAL_CHARS = {
+    "%": "\\@percentchar",
+    "#": "\\string#",
+    "\\": "\\@backslashchar",
+    "{": "\\@charlb",
+    "}": "\\@charrb",
+}
+
+# Reads the labels and citations of the aux file of the whole document,
+# keeping those of the draft, so that they are not defined twice. Counters
+# set by the aux files of included files are left alone.
+READ_AUX = ("\\makeatletter\\begingroup\\let\\setcounter\\@gobbletwo"
+            "\\def\\@newl@bel#1#2#3{\\@ifundefined{#1@#2}"
+            "{\\global\\@namedef{#1@#2}{#3}}{}}"
+            "\\InputIfFileExists{%s}{}{}\\endgroup\\makeatother")
+# \includeonly can only be used in the preamble, which is skipped when
+# compiling with a preamble format, so the draft sets its list of files
+# after \begin{document} like \includeonly does.
+INCLUDE_ONLY = ("\\makeatletter\\@partswtrue"
+                "\\edef\\@partlist{\\zap@space %s \\@empty}\\makeatother")
+
+
+def split_lines(text):
+    """Split `text` into lines, keeping the line ends."""
+    lines = []
+    pos = 0
+    for eol in eol_re.finditer(text):
+        lines.append(text[pos:eol.end()])
+        pos = eol.end()
+    lines.append(text[pos:])
+    return lines
+
+
+def tex_file_name(name):
+    """Return the LaTeX code of the file name `name`."""
+    parts = []
+    pos = 0
+    for match in special_chars_re.finditer(name):
+        if match.start() > pos:
+            parts.append("\\detokenize{" + name[pos:match.start()] + "}")
+        parts.append(SPECIAL_CHARS[match.group()])
+        pos = match.end()
+    if pos < len(name):
+        parts.append("\\detokenize{" + name[pos:] + "}")
+    return "".join(parts)
+
+
+def draft_document(text, line, aux_name):
+    """Return a draft of `text` compiling only the part around `line`, or
+    None if there is no such part.
+
+    If `line` has an \\include, the draft compiles that file only, like
+    \\includeonly. Otherwise it compiles the chapter or section containing
+    `line`, and reads the labels and citations of the whole document from
+    the aux file `aux_name`. The draft is compiled in the build directory of
+    the document, so the name is relative to it.
+
+    The draft only differs from `text` after \\begin{document}, so that it
+    has the same preamble format.
+    """
+    lines = split_lines(text)
+    begin = end = None
+    for i, s in enumerate(lines):
+        if begin is None:
+            match = begin_document_re.match(s)
+            if match is not None:
+                begin = i
+                begin_match = match
+        elif end_document_re.match(s):
+            end = i
+            break
+    if begin is None:
+        return None
+    if end is None:
+        end = len(lines)
+    if not begin < line < end:
+        return None
+
+    s = lines[begin]
+    pos = begin_match.end()
+    match = include_re.match(lines[line])
+    if match is not None:
+        lines[begin] = s[:pos] + INCLUDE_ONLY % match.group(1) + s[pos:]
+        return "".join(lines)
+
+    sections = []
+    for i in range(begin + 1, end):
+        match = section_re.match(lines[i])
+        if match is not None:
+            sections.append((i, SECTION_LEVELS[match.group(1)]))
+    levels = [level for _, level in sections if level > 0]
+    if not levels:
+        return None
+    # Compile the part between the surrounding headings of the top level,
+    # i.e. chapters in a book and sections in an article.
+    top = min(levels)
+    first = begin + 1
+    last = end
+    for i, level in sections:
+        if level > top:
+            continue
+        if i <= line:
+            first = i
+        else:
+            last = i
+            break
+
+    for i in range(begin + 1, end):
+        if not first <= i < last:
+            s = lines[i]
+            eol = eol_re.search(s)
+            lines[i] = s[eol.start():] if eol is not None else ""
+    s = lines[begin]
+    lines[begin] = s[:pos] + READ_AUX % tex_file_name(aux_name) + s[pos:]
+    return "".join(lines)
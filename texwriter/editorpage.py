@@ -1,16 +1,31 @@
 import logging
+import os
 import re
+import shlex
+import threading
 from gi.repository import GObject
 from gi.repository import Gtk
 from gi.repository import Gio
 from gi.repository import GLib
 from gi.repository import Adw
 from .autocomplete import AutocompletePopover
+from .builder import BuildScheduler, LatexmkBuilder
+from .builder import copy_outputs, get_build_directory
+from .buildstats import BuildHistory, BuildRecord
+from .buildstats import CANCELLED, FAILED, SUCCESS, UP_TO_DATE
+from .fingerprint import InputFingerprint, text_digest
+from .draft import draft_document
 from .parser import LatexParser
+from .preamble import (format_command, format_name, get_preamble,
+                       prune_formats)
 from .latex_to_image import LatexToImage
 from .latexbuffer import LatexBuffer
+from .tokenizer import REFERENCE_COMMAND
+from . import synctex
 
 TEXT_ONLY = Gtk.TextSearchFlags.TEXT_ONLY
+REFERENCE_RE = re.compile(REFERENCE_COMMAND + r"\{([^}]*)\}")
+FORMAT_DIR = os.path.join(GLib.get_user_cache_dir(), "texwriter", "formats")
 logger = logging.getLogger("Texwriter")
 
 @Gtk.Template(resource_path="/com/github/molnarandris/texwriter/ui/editorpage.ui")
@@ -20,6 +35,11 @@ class EditorPage(Gtk.ScrolledWindow):
     textview = Gtk.Template.Child()
     title = GObject.Property(type=str, default="New Document")
 
+    __gsignals__ = {
+        'compile-requested': (GObject.SignalFlags.RUN_FIRST, None, ()),
+        'build-output': (GObject.SignalFlags.RUN_FIRST, None, (str,)),
+    }
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
@@ -28,14 +48,42 @@ class EditorPage(Gtk.ScrolledWindow):
         self.synctex_task = None
         self.open_task = None
         self.file = None
+        self.builder = None
+        self.failed_formats = set()
+        # Whether the outputs shown are those of a draft.
+        self.draft = False
+        # The build directory of the last build, or None.
+        self.build_dir = None
+        self.build_history = BuildHistory()
+        # The key and the InputFingerprint of the last successful build.
+        self.last_build = None
+        # The file last loaded or saved, and the digest of its content.
+        self.saved_file = None
+        self.saved_digest = None
+        # None, or whether the build to start when the running one finishes
+        # is a draft.
+        self.compile_pending = None
+        # Whether a build was requested and has not completed yet, including
+        # while the document is saved for it and while it waits for its turn.
+        self.building = False
+        self.auto_compile_id = 0
+        # Whether the page was closed.
+        self.closed = False
+        self.settings = Gio.Settings.new("com.github.molnarandris.texwriter")
 
         self.popover = AutocompletePopover(self.textview)
         buffer = LatexBuffer()
         self.textview.set_buffer(buffer)
         buffer.connect("modified-changed", self.on_buffer_modified_changed)
+        buffer.connect("changed", self.on_buffer_changed)
         buffer.create_tag('highlight', background='red')
 
         self.parser = LatexParser(buffer)
+        self.parser.connect("packages-changed", self.on_packages_changed)
+        self.popover.labels = self.parser.labels
+        vadjustment = self.get_vadjustment()
+        vadjustment.connect("value-changed", self.on_viewport_changed)
+        vadjustment.connect("notify::page-size", self.on_viewport_changed)
 
 
     @property
@@ -46,6 +94,22 @@ class EditorPage(Gtk.ScrolledWindow):
         prefix = "• " if self.modified else ""
         self.props.title = prefix + self.display_name
 
+    def on_buffer_changed(self, buffer):
+        """Restart the auto-compile timeout."""
+        if self.auto_compile_id:
+            GLib.source_remove(self.auto_compile_id)
+            self.auto_compile_id = 0
+        if self.file is None or not self.settings.get_boolean("auto-compile"):
+            return
+        delay = self.settings.get_int("auto-compile-delay")
+        self.auto_compile_id = GLib.timeout_add(delay, self.auto_compile_cb)
+
+    def auto_compile_cb(self):
+        self.auto_compile_id = 0
+        if self.modified:
+            self.emit("compile-requested")
+        return GLib.SOURCE_REMOVE
+
     def open_async(self, file, cancellable, callback, *user_data):
         if self.open_task:
             self.open_task.get_cancellable().cancel()
@@ -92,9 +156,18 @@ class EditorPage(Gtk.ScrolledWindow):
             task.return_error(GLib.Error("Unable to decode file"))
             return
 
+        # Highlighting a large file takes long, so it is done in the
+        # background, starting with the visible lines.
         buffer = self.textview.props.buffer
-        buffer.props.text = text
+        self.parser.load_text(text)
+        buffer.place_cursor(buffer.get_start_iter())
+        self.parser.set_visible_lines(*self.get_visible_lines())
         self.file = file
+        self.saved_file = file
+        self.saved_digest = text_digest(text)
+        self.draft = False
+        self.build_dir = None
+        self.last_build = None
         buffer.set_modified(False)  # This also updates the title
         task.return_boolean(True)
 
@@ -124,9 +197,19 @@ class EditorPage(Gtk.ScrolledWindow):
         self.save_task = task
 
         buffer = self.textview.props.buffer
+        same_file = self.saved_file is not None and self.file.equal(self.saved_file)
+        if same_file and not self.modified:
+            task.return_boolean(True)
+            return
         start_it = buffer.get_start_iter()
         end_it = buffer.get_end_iter()
         text = buffer.get_text(start_it, end_it, False)
+        task.digest = text_digest(text)
+        if same_file and task.digest == self.saved_digest:
+            # The edits since the last save were undone.
+            buffer.set_modified(False)
+            task.return_boolean(True)
+            return
         bytes = GLib.Bytes.new(text.encode('utf-8'))
 
         self.file.replace_contents_bytes_async(contents=bytes,
@@ -145,6 +228,8 @@ class EditorPage(Gtk.ScrolledWindow):
             return
         self.textview.get_buffer().set_modified(False)
         self.file = file
+        self.saved_file = file
+        self.saved_digest = task.digest
         self.title = self.display_name
         task.return_boolean(True)
         return
@@ -159,7 +244,11 @@ class EditorPage(Gtk.ScrolledWindow):
             raise(err)
         return result.propagate_boolean()
 
-    def compile_async(self, cancellable, callback, user_data=None):
+    def compile_async(self, cancellable, callback, user_data=None,
+                      draft=False, record=None):
+        """Compile the document, or if `draft` is True, only the part of it
+        around the cursor. The stages are timed in `record` if it is not
+        None."""
         if self.compile_task:
             assert self.compile_task.get_cancellable is not None
             self.compile_task.get_cancellable().cancel()
@@ -170,35 +259,279 @@ class EditorPage(Gtk.ScrolledWindow):
             original_callback(source_object, result, user_data)
 
         task = Gio.Task.new(self, cancellable, callback, user_data)
-        self.synctex_task = task
+        self.compile_task = task
+        task.record = record
 
         pwd = self.file.get_parent().get_path()
-        cmd = ['flatpak-spawn', '--host', 'latexmk', '-synctex=1',
-               '-interaction=nonstopmode', '-pdf', "-g",
-               "--output-directory=" + pwd,
-               self.file.get_path()]
-        flags = Gio.SubprocessFlags.STDOUT_SILENCE
-        flags = flags | Gio.SubprocessFlags.STDERR_SILENCE
-        proc = Gio.Subprocess.new(cmd, flags)
-        proc.wait_async(cancellable, self.compile_cb, task)
+        if self.builder is None or self.builder.directory != pwd:
+            if self.builder is not None:
+                self.builder.stop()
+            self.builder = LatexmkBuilder(pwd)
+            self.builder.connect("output", self.on_build_output)
 
-    def compile_cb(self, source, result, task):
+        task.build_dir = self.get_build_directory()
         try:
-            source.wait_finish(result)
-        except GLib.Error as err:
-            task.return_error(err)
+            os.makedirs(task.build_dir, exist_ok=True)
+        except OSError as err:
+            task.return_error(GLib.Error(f"Unable to create build directory: {err.strerror}"))
             return
-        if not source.get_successful():
-            err = GLib.Error("Compilation failed",
-                             GLib.Spawn_error_quark(),
-                             GLib.SpawnErrorEnum.FAILED)
+
+        buffer = self.textview.props.buffer
+        task.draft = draft
+        if draft:
+            start_it, end_it = buffer.get_bounds()
+            text = buffer.get_text(start_it, end_it, False)
+            it = buffer.get_iter_at_mark(buffer.get_insert())
+            # TeX looks for input files in the output directory first.
+            text = draft_document(text, it.get_line(), self.get_stem() + ".aux")
+            if text is None:
+                task.return_error(GLib.Error("No chapter or section at the cursor"))
+                return
+            task.source = self.get_draft_path(task.build_dir)
+            task.key = (task.source, task.build_dir, text_digest(text))
+            if self.check_up_to_date(task):
+                return
+            try:
+                with open(task.source, "w", encoding="utf-8") as f:
+                    f.write(text)
+            except OSError as err:
+                task.return_error(GLib.Error(f"Unable to write draft: {err.strerror}"))
+                return
+            preamble = get_preamble(text)
+        else:
+            task.source = self.file.get_path()
+            task.key = (task.source, task.build_dir, None)
+            if self.check_up_to_date(task):
+                return
+            start_it = buffer.get_start_iter()
+            result = start_it.forward_search("\\begin{document}", TEXT_ONLY, None)
+            if result is None:
+                preamble = None
+            else:
+                preamble = get_preamble(buffer.get_text(start_it, result[1], False))
+
+        # Dump the preamble into a format first, unless it has not changed
+        # since the last build.
+        task.format = self.get_preamble_format(preamble)
+        if task.format is not None and not os.path.exists(task.format + ".fmt"):
+            try:
+                os.makedirs(FORMAT_DIR, exist_ok=True)
+            except OSError as err:
+                logger.warning("Unable to create %s: %s", FORMAT_DIR, err.strerror)
+                task.format = None
+                self.build(task)
+                return
+            name = os.path.basename(task.format)
+            cmd = format_command(name, FORMAT_DIR, task.source)
+            self.begin_stage(record, "format")
+            self.builder.build_async(cmd, cancellable, self.format_cb, task)
+            return
+        self.build(task)
+
+    def check_up_to_date(self, task):
+        """Complete `task` without building if none of the inputs of the last
+        build changed since then. Returns whether the task was completed.
+        """
+        self.begin_stage(task.record, "check")
+        up_to_date = False
+        if self.last_build is not None:
+            key, fingerprint = self.last_build
+            pdf_path = self.get_output_path(task.draft, "pdf", task.build_dir)
+            up_to_date = (key == task.key and os.path.exists(pdf_path)
+                          and not fingerprint.changed())
+        if not up_to_date:
+            self.end_stage(task.record, "check")
+            # The outputs are about to change.
+            self.last_build = None
+            return False
+        self.end_stage(task.record, "check", outcome=UP_TO_DATE)
+        self.draft = task.draft
+        self.build_dir = task.build_dir
+        task.return_boolean(False)
+        return True
+
+    def get_preamble_format(self, preamble):
+        """Return the path of the format of `preamble`, without extension,
+        or None if the document should be compiled without a format.
+        """
+        if preamble is None:
+            return None
+        name = format_name(preamble, self.file.get_parent().get_path())
+        if name in self.failed_formats:
+            return None
+        return os.path.join(FORMAT_DIR, name)
+
+    def get_build_directory(self):
+        source_dir = self.file.get_parent().get_path()
+        base = self.settings.get_string("build-directory")
+        return get_build_directory(source_dir, os.path.expanduser(base))
+
+    def get_stem(self):
+        return os.path.splitext(self.file.get_basename())[0]
+
+    def get_draft_path(self, build_dir=None):
+        build_dir = build_dir or self.build_dir or self.get_build_directory()
+        return os.path.join(build_dir, self.get_stem() + "-draft.tex")
+
+    def get_output_path(self, draft, ext, build_dir=None):
+        build_dir = build_dir or self.build_dir or self.get_build_directory()
+        stem = self.get_stem() + "-draft" if draft else self.get_stem()
+        return os.path.join(build_dir, stem + "." + ext)
+
+    def output_file(self, ext):
+        """Return the output file of the last build with extension `ext`.
+
+        Before the first build, the build directory may be empty, e.g. after
+        a reboot. Then the outputs copied next to the sources are used.
+        """
+        path = self.get_output_path(self.draft, ext)
+        if not self.draft and not os.path.exists(path):
+            source_dir = self.file.get_parent().get_path()
+            path = os.path.join(source_dir, os.path.basename(path))
+        return Gio.File.new_for_path(path)
+
+    def format_cb(self, builder, result, task):
+        try:
+            builder.build_finish(result)
+            if not os.path.exists(task.format + ".fmt"):
+                raise GLib.Error("No format was written")
+        except GLib.Error as err:
+            self.end_stage(task.record, "format", err)
+            if err.matches(Gio.io_error_quark(), Gio.IOErrorEnum.CANCELLED):
+                task.return_error(err)
+                return
+            # Not every preamble can be dumped. Such documents are compiled
+            # as they are.
+            logger.warning("Unable to precompile the preamble: %s", err.message)
+            self.failed_formats.add(os.path.basename(task.format))
+            try:
+                os.remove(task.format + ".fmt")
+            except OSError:
+                pass
+            task.format = None
+        else:
+            self.end_stage(task.record, "format")
+            prune_formats(FORMAT_DIR)
+        self.build(task)
+
+    def build(self, task):
+        cmd = ['latexmk', '-synctex=1', '-interaction=nonstopmode', '-pdf',
+               "-g", "--output-directory=" + task.build_dir]
+        if task.format is not None:
+            # Keep the format from being pruned.
+            try:
+                os.utime(task.format + ".fmt")
+            except OSError as err:
+                # Pruned by another build. It is dumped again next time.
+                logger.warning("Unable to use the format: %s", err.strerror)
+                task.format = None
+            else:
+                cmd.append("-pdflatex=pdflatex -fmt=" + shlex.quote(task.format)
+                           + " %O %S")
+        cmd.append(task.source)
+        self.begin_stage(task.record, "latex")
+        self.builder.build_async(cmd, task.get_cancellable(),
+                                 self.compile_cb, task)
+
+    def compile_cb(self, builder, result, task):
+        try:
+            builder.build_finish(result)
+        except GLib.Error as err:
+            self.end_stage(task.record, "latex", err)
+            if not err.matches(Gio.io_error_quark(), Gio.IOErrorEnum.CANCELLED):
+                self.draft = task.draft
+                self.build_dir = task.build_dir
             task.return_error(err)
             return
+        self.end_stage(task.record, "latex")
+        self.draft = task.draft
+        self.build_dir = task.build_dir
+
+        # Keep the PDF and SyncTeX next to the sources for other programs,
+        # and fingerprint the inputs, in a worker thread. The next build only
+        # starts when this is done, so the copies are never partial.
+        source_dir = self.file.get_parent().get_path()
+        copy = not task.draft and task.build_dir != source_dir
+        args = (task.build_dir, source_dir, self.get_stem(), ("pdf", "synctex.gz"))
+        fls_path = self.get_output_path(task.draft, "fls", task.build_dir)
+        def worker():
+            if copy:
+                copy_outputs(*args)
+            try:
+                fingerprint = InputFingerprint.from_fls(fls_path)
+            except OSError as err:
+                logger.warning("Unable to read %s: %s", fls_path, err.strerror)
+                fingerprint = None
+            GLib.idle_add(self.outputs_done, task, fingerprint)
+        self.begin_stage(task.record, "outputs")
+        threading.Thread(target=worker, daemon=True).start()
+
+    def outputs_done(self, task, fingerprint):
+        self.end_stage(task.record, "outputs")
+        if fingerprint is not None:
+            self.last_build = (task.key, fingerprint)
         task.return_boolean(True)
+        return GLib.SOURCE_REMOVE
+
+
+    def begin_build(self, draft):
+        """Return a new record of a build, added to the build history."""
+        record = BuildRecord(self.display_name, draft)
+        self.build_history.add(record)
+        self.result_view.historyview.refresh()
+        return record
+
+    def begin_stage(self, record, name):
+        if record is None:
+            return
+        record.begin(name)
+        self.result_view.historyview.refresh()
+
+    def end_stage(self, record, name, err=None, outcome=None):
+        """End the stage `name` of `record`, that failed with `err` if it is
+        not None. `outcome` overrides the outcome derived from `err`."""
+        if record is None:
+            return
+        if outcome is None:
+            if err is None:
+                outcome = SUCCESS
+            elif err.matches(Gio.io_error_quark(), Gio.IOErrorEnum.CANCELLED):
+                outcome = CANCELLED
+            else:
+                outcome = FAILED
+        record.end(name, outcome)
+        self.result_view.historyview.refresh()
+
+    def on_build_output(self, builder, line):
+        self.emit("build-output", line)
+
+    def cancel_compile(self):
+        """Stop the running or queued build. The build is reported as
+        cancelled once LaTeX was terminated on the host."""
+        self.compile_pending = None
+        BuildScheduler.get_default().cancel(self)
+        if self.compile_task is not None:
+            self.compile_task.get_cancellable().cancel()
 
+    def close(self):
+        """Stop the builds of the page and its worker on the host when the
+        page is closed."""
+        self.closed = True
+        if self.auto_compile_id:
+            GLib.source_remove(self.auto_compile_id)
+            self.auto_compile_id = 0
+        self.compile_pending = None
+        BuildScheduler.get_default().remove(self)
+        if self.compile_task is not None:
+            self.compile_task.get_cancellable().cancel()
+        if self.builder is not None:
+            self.builder.stop()
+            self.builder = None
 
     def compile_finish(self, result):
-        self.compile_cancellable = None
+        """Return True if the document was built, False if the outputs of
+        the last build were up to date."""
+        self.compile_task = None
 
         if not Gio.Task.is_valid(result, self):
             err = GLib.Error("Compilation failed",
@@ -227,9 +560,10 @@ class EditorPage(Gtk.ScrolledWindow):
 
         buffer = self.textview.props.buffer
         it = buffer.get_iter_at_mark(buffer.get_insert())
-        path = self.file.get_path()
+        path = self.get_draft_path() if self.draft else self.file.get_path()
         pos = str(it.get_line()) + ":" + str(it.get_line_offset()) + ":" + path
-        cmd = ['flatpak-spawn', '--host', 'synctex', 'view', '-i', pos, '-o', path]
+        pdf_path = self.output_file("pdf").get_path()
+        cmd = ['flatpak-spawn', '--host', 'synctex', 'view', '-i', pos, '-o', pdf_path]
         flags = Gio.SubprocessFlags.STDOUT_PIPE | Gio.SubprocessFlags.STDERR_SILENCE
         proc = Gio.Subprocess.new(cmd, flags)
 
@@ -249,16 +583,7 @@ class EditorPage(Gtk.ScrolledWindow):
             task.return_error(err)
             return
 
-        record = "Page:(.*)\n.*\n.*\nh:(.*)\nv:(.*)\nW:(.*)\nH:(.*)"
-        rectangles = []
-        for match in re.findall(record, stdout):
-            page = int(match[0])-1
-            x = float(match[1])
-            y = float(match[2])
-            width = float(match[3])
-            height = float(match[4])
-            rectangles.append((width, height, x, y, page))
-        task.rectangles = rectangles
+        task.rectangles = synctex.parse_view(stdout)
         task.return_boolean(True)
 
     def synctex_finish(self, result):
@@ -286,6 +611,49 @@ class EditorPage(Gtk.ScrolledWindow):
             display_name = file.get_basename()
         return display_name
 
+    def on_packages_changed(self, parser):
+        self.popover.set_packages(parser.packages)
+
+    def on_viewport_changed(self, *_args):
+        self.parser.set_visible_lines(*self.get_visible_lines())
+
+    def get_visible_lines(self):
+        rect = self.textview.get_visible_rect()
+        top, _ = self.textview.get_line_at_y(rect.y)
+        bottom, _ = self.textview.get_line_at_y(rect.y + rect.height)
+        return top.get_line(), bottom.get_line()
+
+    def goto_definition(self):
+        """Scroll to the label referenced at the cursor.
+
+        Returns False if there is no known label referenced at the cursor.
+        """
+        buffer = self.textview.props.buffer
+        it = buffer.get_iter_at_mark(buffer.get_insert())
+        start_it = it.copy()
+        start_it.set_line_offset(0)
+        end_it = it.copy()
+        if not end_it.ends_line():
+            end_it.forward_to_line_end()
+        text = buffer.get_slice(start_it, end_it, True)
+        offset = it.get_line_offset()
+        for match in REFERENCE_RE.finditer(text):
+            if match.start() <= offset <= match.end():
+                # Take the label under the cursor, or the first one if the
+                # cursor is on the command.
+                pos = match.start(1)
+                for name in match.group(1).split(","):
+                    if offset <= pos + len(name):
+                        break
+                    pos += len(name) + 1
+                name = name.strip()
+                line = self.parser.labels.get_line(name)
+                if line is None:
+                    return False
+                self.scroll_to(line, "\\label{" + name + "}")
+                return True
+        return False
+
     def scroll_to(self, line, word=None):
         buffer = self.textview.props.buffer
         _, it = buffer.get_iter_at_line(line)
@@ -303,6 +671,7 @@ class EditorPage(Gtk.ScrolledWindow):
 
     def convert_inline_math(self):
         buffer = self.textview.props.buffer
+        self.parser.highlight_all()
         it = buffer.get_start_iter()
         tag = buffer.props.tag_table.lookup("inline-math")
         if tag is None:
@@ -0,0 +1,82 @@
+"""Fingerprints of the inputs of a build.
+
+latexmk makes LaTeX record every file it reads in a .fls file. Checking
+those files tells whether building again would produce the same output.
+"""
+
+import hashlib
+import os
+
+
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def text_digest(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def parse_fls(text):
+    """Return the paths of the files read according to the .fls `text`,
+    in the order they were first read.
+
+    Files that were also written, like the .aux file, are left out.
+    """
+    pwd = ""
+    inputs = {}
+    outputs = set()
+    for line in text.splitlines():
+        if line.startswith("PWD "):
+            pwd = line[4:]
+        elif line.startswith("INPUT "):
+            inputs[os.path.normpath(os.path.join(pwd, line[6:]))] = None
+        elif line.startswith("OUTPUT "):
+            outputs.add(os.path.normpath(os.path.join(pwd, line[7:])))
+    return [path for path in inputs if path not in outputs]
+
+
+class InputFingerprint:
+    """The size, modification time and digest of the inputs of a build.
+
+    Inputs that cannot be read, e.g. files of the TeX distribution on the
+    host, are left out.
+    """
+
+    def __init__(self, paths):
+        self.files = {}
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                digest = file_digest(path)
+            except OSError:
+                continue
+            self.files[path] = (stat.st_size, stat.st_mtime_ns, digest)
+
+    @classmethod
+    def from_fls(cls, fls_path):
+        """Return the fingerprint of the inputs listed in the .fls file at
+        `fls_path`."""
+        with open(fls_path, encoding="utf-8", errors="replace") as f:
+            return cls(parse_fls(f.read()))
+
+    def changed(self):
+        """Return whether the content of any of the inputs changed."""
+        for path, (size, mtime, digest) in self.files.items():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return True
+            if stat.st_size == size and stat.st_mtime_ns == mtime:
+                continue
+            # The file was written, but maybe with the same content.
+            try:
+                if stat.st_size != size or file_digest(path) != digest:
+                    return True
+            except OSError:
+                return True
+            self.files[path] = (size, stat.st_mtime_ns, digest)
+        return False
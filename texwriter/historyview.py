@@ -0,0 +1,57 @@
+import time
+from gi.repository import Gtk
+from gi.repository import Adw
+from .buildstats import SUCCESS
+
+
+class BuildHistoryView(Gtk.ListBox):
+    """Lists the builds of a document, newest first, with the time spent in
+    each stage."""
+    __gtype_name__ = "BuildHistoryView"
+
+    def __init__(self):
+        super().__init__()
+        self.history = None
+        self.add_css_class("boxed-list")
+        self.set_selection_mode(Gtk.SelectionMode.NONE)
+        self.set_margin_start(20)
+        self.set_margin_end(20)
+        self.set_margin_top(10)
+        self.set_vexpand(False)
+        self.set_valign(Gtk.Align.START)
+        self.connect("map", lambda _: self.refresh())
+
+    def set_history(self, history):
+        self.history = history
+        self.refresh()
+
+    def refresh(self):
+        # The list is rebuilt when it is shown.
+        if not self.get_mapped():
+            return
+        self.remove_all()
+        if self.history is None:
+            return
+        for record in reversed(self.history.records):
+            self.append(self.create_row(record))
+
+    def create_row(self, record):
+        row = Adw.ActionRow.new()
+        row.set_use_markup(False)
+        started = time.strftime("%H:%M:%S", time.localtime(record.started))
+        kind = "Draft" if record.draft else "Build"
+        if record.running:
+            status = "running"
+        else:
+            status = f"{record.duration:.2f} s, {record.outcome}"
+        row.set_title(f"{kind} at {started}: {status}")
+        stages = []
+        for name, _start, duration, outcome in record.stages:
+            if duration is None:
+                stages.append(f"{name} …")
+            elif outcome == SUCCESS:
+                stages.append(f"{name} {duration:.2f} s")
+            else:
+                stages.append(f"{name} {duration:.2f} s ({outcome})")
+        row.set_subtitle(" · ".join(stages))
+        return row
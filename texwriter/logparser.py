@@ -0,0 +1,109 @@
+"""Incremental parser of LaTeX logs.
+
+The parser is fed one line at a time, so the output of a running compiler can
+be parsed as it arrives.
+"""
+
+import re
+from collections import namedtuple
+
+# Entry kinds.
+BADBOX = "badbox"
+WARNING = "warning"
+ERROR = "error"
+
+# `line` is the 1-based line of the source the entry refers to, or None if it
+# is not known, `text` is the text to look for in that line, or None.
+LogEntry = namedtuple("LogEntry", ["kind", "title", "line", "text"])
+
+badbox_re = re.compile(r"((?:Over|Under)full \\[hv]box).* ([0-9]+)--[0-9]+")
+warning_re = re.compile(r"LaTeX Warning: (Reference|Citation) `(.*)'.* ([0-9]*)\.$")
+error_re = re.compile(r"! (.*)")
+error_line_re = re.compile(r"l\.(\d+)")
+# Printed by latexmk before each run of a rule, e.g. of pdflatex.
+run_start_re = re.compile(r"Run number \d+ of rule")
+
+
+class LogParser:
+    """Turns the lines of a log into LogEntry tuples."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # The message of the error being parsed, the last word of the line
+        # following it, and the number of empty lines since.
+        self.error = None
+        self.error_text = None
+        self.empty_lines = 0
+
+    def feed(self, line):
+        """Parse the next line, and return the list of entries it
+        completed."""
+        line = line.rstrip("\r\n")
+        entries = []
+
+        if self.error is not None:
+            match = error_line_re.match(line)
+            if match is None and self.ends_error(line):
+                # Some errors, like fatal ones, have no source line.
+                entries.extend(self.finish())
+            else:
+                if self.error_text is None:
+                    words = line.split()
+                    self.error_text = words[-1] if words else ""
+                if match is None:
+                    return []
+                title = self.error + " : " + self.error_text
+                entry = LogEntry(ERROR, title, int(match.group(1)), self.error_text)
+                self.reset()
+                return [entry]
+
+        match = error_re.match(line)
+        if match is not None:
+            self.error = match.group(1)
+            return entries
+
+        match = badbox_re.match(line)
+        if match is not None:
+            entries.append(LogEntry(BADBOX, match.group(1), int(match.group(2)), None))
+            return entries
+
+        match = warning_re.match(line)
+        if match is not None and match.group(3):
+            title = "Undefined " + match.group(1).lower() + ": " + match.group(2)
+            entries.append(LogEntry(WARNING, title, int(match.group(3)),
+                                    match.group(2)))
+        return entries
+
+    def ends_error(self, line):
+        """Return whether `line` shows that the error being parsed has no
+        source line."""
+        if error_re.match(line) or badbox_re.match(line) or warning_re.match(line):
+            return True
+        if line:
+            return False
+        # TeX pads the lines of the context of errors with spaces, so they
+        # are never empty. The messages of LaTeX and package errors are
+        # followed by an empty line and their help text.
+        self.empty_lines += 1
+        return self.empty_lines > ("Error:" in self.error)
+
+    def finish(self):
+        """Return the entries of the error being parsed at the end of the
+        log, if any."""
+        if self.error is None:
+            return []
+        entry = LogEntry(ERROR, self.error, None, None)
+        self.reset()
+        return [entry]
+
+
+def parse_log(text):
+    """Return the list of entries of the log `text`."""
+    parser = LogParser()
+    entries = []
+    for line in text.splitlines():
+        entries.extend(parser.feed(line))
+    entries.extend(parser.finish())
+    return entries
@@ -4,7 +4,7 @@ from gi.repository import Adw
 from gi.repository import GObject
 from gi.repository import GLib
 import logging
-import re
+from .logparser import LogParser, parse_log, run_start_re
 
 logger = logging.getLogger("Texwriter")
 
@@ -15,6 +15,7 @@ class LogViewer(Gtk.ListBox):
     def __init__(self):
         super().__init__()
         self.file = None
+        self.parser = LogParser()
         self.add_css_class("boxed-list")
         self.set_margin_start(20)
         self.set_margin_end(20)
@@ -22,13 +23,22 @@ class LogViewer(Gtk.ListBox):
         self.set_vexpand(False)
         self.set_valign(Gtk.Align.START)
 
-    def load_file(self, file=None):
-        """Open File from command line or open / open recent etc."""
-        self.remove_all()
+    def load_file(self, file=None, callback=None):
+        """Open File from command line or open / open recent etc.
+
+        `callback` is called without arguments when the file is parsed or
+        failed to load.
+        """
+        self.clear()
         logger.info("Opening %s", file.get_uri())
-        file.load_contents_async(None, self.load_file_complete)
+        file.load_contents_async(None, self.load_file_complete, callback)
 
-    def load_file_complete(self, file, result):
+    def load_file_complete(self, file, result, callback):
+        self.parse_file(file, result)
+        if callback is not None:
+            callback()
+
+    def parse_file(self, file, result):
         try:
             success, contents, msg = file.load_contents_finish(result)
         except GLib.Error as err:
@@ -52,30 +62,36 @@ class LogViewer(Gtk.ListBox):
             logger.warning(f"Unable to load the contents of the log file at {path}: the file is not encoded with UTF-8")
             return
 
-        badbox_re  = re.compile("^((?:Over|Under)full \\\\[hv]box).* ([0-9]+)--[0-9]+.*\\n",re.MULTILINE)
-        warning_re = re.compile("^LaTeX Warning: (Reference|Citation) `(.*)'.* ([0-9]*)\\.\\n",re.MULTILINE)
-        error_re   = re.compile("^! (.*)\\n.* (.+)\\n(?s:.*)^l\\.(\\d*).*",re.MULTILINE)
+        for entry in parse_log(text):
+            self.add_entry(entry)
 
-        for match in re.finditer(badbox_re, text):
-            title = match.group(1)
-            line = int(match.group(2))
-            self.add_row(title, line)
+    def clear(self):
+        """Remove all rows, e.g. before parsing the output of a build."""
+        self.remove_all()
+        self.parser.reset()
 
-        for match in re.finditer(warning_re, text):
-            title = "Undefined " + match.group(1).lower() + ": " + match.group(2)
-            line = int(match.group(3))
-            self.add_row(title, line, match.group(2))
+    def add_line(self, line):
+        """Parse the next line of the output of a running build.
 
-        for match in re.finditer(error_re, text):
-            title = match.group(1) + " : " + match.group(2)
-            line = int(match.group(3))
-            self.add_row(title, line, match.group(2))
+        Returns the list of entries added.
+        """
+        if run_start_re.match(line):
+            # Every run of LaTeX repeats the messages of the previous one.
+            self.clear()
+            return []
+        entries = self.parser.feed(line)
+        for entry in entries:
+            self.add_entry(entry)
+        return entries
 
+    def add_entry(self, entry):
+        self.add_row(entry.title, entry.line, entry.text)
 
     def add_row(self, title, line, text=None):
         row = Adw.ActionRow.new()
-        row.set_activatable(True)
-        row.line = line - 1
+        # Errors without a source line cannot be jumped to.
+        row.set_activatable(line is not None)
+        row.line = line - 1 if line is not None else None
         row.text = text
         row.set_use_markup(False)
         row.set_title(title)
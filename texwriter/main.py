@@ -42,6 +42,10 @@ class TexwriterApplication(Adw.Application):
         action.connect("activate", self.on_new)
         self.add_action(action)
 
+        action = Gio.SimpleAction.new('compile-all', None)
+        action.connect("activate", self.on_compile_all)
+        self.add_action(action)
+
         action = Gio.SimpleAction.new('about', None)
         action.connect("activate", self.on_about_action)
         self.add_action(action)
@@ -56,8 +60,12 @@ class TexwriterApplication(Adw.Application):
         self.set_accels_for_action("win.save(false)", ['<primary>s'])
         self.set_accels_for_action("win.save(true)", ['<primary><shift>s'])
         self.set_accels_for_action("win.compile", ['F5'])
+        self.set_accels_for_action("win.compile-draft", ['<shift>F5'])
+        self.set_accels_for_action("win.cancel-compile", ['<primary>F5'])
+        self.set_accels_for_action("app.compile-all", ['<primary><shift>F5'])
         self.set_accels_for_action("win.convert-inline-math", ['F6'])
         self.set_accels_for_action("win.synctex-fwd", ['F7'])
+        self.set_accels_for_action("win.goto-definition", ['F12'])
 
 
     def do_activate(self):
@@ -106,6 +114,11 @@ class TexwriterApplication(Adw.Application):
         if quit:
             self.quit()
 
+    def on_compile_all(self, _action, _param):
+        for window in self.get_windows():
+            if isinstance(window, TexwriterWindow):
+                window.compile_all()
+
     def on_new(self, _action, _param):
         win = TexwriterWindow(application=self)
         win.present()
@@ -0,0 +1,78 @@
+"""A cache of the rendered tiles of PDF pages.
+
+Rendering a page with Poppler is slow, so the rendered pages are kept and
+drawn again until the page or the scale changes. Pages are cut into tiles,
+so that only the visible part of a page is rendered and kept at large zoom
+levels. The least recently used tiles are dropped when the cache gets over
+its memory budget.
+"""
+
+from collections import OrderedDict
+
+# Size of the side of the tiles, in pixels.
+TILE_SIZE = 1024
+
+
+def get_tiles(width, height, rect=None, tile_size=TILE_SIZE):
+    """Return the tiles of a `width` × `height` image that intersect the
+    (x, y, width, height) `rect`, as (x, y, width, height) tuples.
+
+    If `rect` is None, every tile is returned.
+    """
+    if rect is None:
+        x0, y0, x1, y1 = 0, 0, width, height
+    else:
+        x, y, w, h = rect
+        x0 = max(0, int(x))
+        y0 = max(0, int(y))
+        x1 = min(width, int(x + w) + 1)
+        y1 = min(height, int(y + h) + 1)
+    tiles = []
+    for ty in range(y0 - y0 % tile_size, y1, tile_size):
+        for tx in range(x0 - x0 % tile_size, x1, tile_size):
+            tiles.append((tx, ty, min(tile_size, width - tx),
+                          min(tile_size, height - ty)))
+    return tiles
+
+
+class PageCache:
+    """A least recently used cache with a memory budget."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        # Maps keys to (value, size) pairs, least recently used first.
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, size):
+        self.remove(key)
+        self.entries[key] = (value, size)
+        self.size += size
+        self.evict()
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def set_budget(self, budget):
+        self.budget = budget
+        self.evict()
+
+    def evict(self):
+        while self.size > self.budget and self.entries:
+            _key, (_value, size) = self.entries.popitem(last=False)
+            self.size -= size
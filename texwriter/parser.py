@@ -1,126 +1,424 @@
-import re
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import Counter
+from gi.repository import GLib
+from gi.repository import GObject
+from .tokenizer import KIND_NAMES, LABEL, PACKAGE, group_spans, tokenize
 
-class LatexParser:
+# Number of lines re-lexed at once when the effect of an edit propagates past
+# the edited lines, and highlighted at once in the background.
+CHUNK_LINES = 32
+
+# Time in seconds a single idle callback may spend highlighting.
+IDLE_BUDGET = 0.005
+
+# Number of lines above and below the visible ones that are highlighted
+# together with them.
+VISIBLE_MARGIN = 50
+
+
+class LabelIndex:
+    """The \\label definitions of a buffer.
+
+    Each definition is tracked by a mark at the start of its line, so that
+    the line stays correct while the buffer is edited without updating the
+    index. The names are also kept sorted for prefix completion.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.marks = {}
+        self.names = []
+
+    def add(self, name, line):
+        _, it = self.buffer.get_iter_at_line(line)
+        mark = self.buffer.create_mark(None, it, True)
+        if name in self.marks:
+            self.marks[name].append(mark)
+        else:
+            self.marks[name] = [mark]
+            insort(self.names, name)
+
+    def remove(self, name, line):
+        marks = self.marks.get(name)
+        if not marks:
+            return
+        # The same label may be defined more than once.
+        mark = next((m for m in marks if self.get_mark_line(m) == line), marks[0])
+        marks.remove(mark)
+        self.buffer.delete_mark(mark)
+        if not marks:
+            del self.marks[name]
+            del self.names[bisect_left(self.names, name)]
+
+    def clear(self):
+        for marks in self.marks.values():
+            for mark in marks:
+                self.buffer.delete_mark(mark)
+        self.marks.clear()
+        self.names.clear()
+
+    def get_mark_line(self, mark):
+        return self.buffer.get_iter_at_mark(mark).get_line()
+
+    def get_line(self, name):
+        """Return the line where `name` is defined, or None."""
+        marks = self.marks.get(name)
+        if not marks:
+            return None
+        return self.get_mark_line(marks[0])
+
+    def complete(self, prefix, n):
+        """Return at most `n` label names starting with `prefix`."""
+        names = self.names
+        start = bisect_left(names, prefix)
+        result = []
+        for name in names[start:start+n]:
+            if not name.startswith(prefix):
+                break
+            result.append(name)
+        return result
+
+
+class LatexParser(GObject.Object):
+    """Highlights a LatexBuffer and keeps track of the symbols, like the
+    loaded packages and labels, that it defines.
+
+    The lexer state at the start of every line is stored, so an edit only has
+    to re-lex from the line it touches until the state at the start of a
+    following line is the same as before the edit.
+
+    Only the visible lines, plus a margin, are highlighted right away. Other
+    lines are highlighted when they are scrolled into view, or when idle.
+    """
+
+    __gsignals__ = {
+        'packages-changed': (GObject.SIGNAL_RUN_FIRST, None, ()),
+    }
 
     def __init__(self, buffer):
+        super().__init__()
 
-        buffer.connect("insert-text", self.before_buffer_insert_text)
-        buffer.connect_after("insert-text", self.after_buffer_insert_text)
+        self.handlers = [
+            buffer.connect_after("insert-text", self.after_buffer_insert_text),
+            buffer.connect_after("delete-range", self.after_buffer_delete_range),
+            buffer.connect_after("insert-paintable", self.after_buffer_insert_paintable),
+        ]
 
         self.buffer = buffer
+        tag_table = buffer.get_tag_table()
+        self.tags = [tag_table.lookup(name) for name in KIND_NAMES]
+
+        # Lexer state at the start of each line of the buffer, and whether
+        # the highlighting of the line is up to date.
+        self.states = bytearray(buffer.get_line_count())
+        self.tagged = bytearray(b"\x01") * buffer.get_line_count()
+
+        # Incremented at every edit, so results computed for an older
+        # version of the text can be recognized.
+        self.generation = 0
+        # Tokens of the whole buffer computed in the background, valid as
+        # long as the buffer is not edited.
+        self.tokens = None
+        self.idle_id = 0
+        self.visible_lines = (0, 0)
+        # False while the worker thread computes the line states.
+        self.states_known = True
+
+        # Symbols defined on each line, as a tuple of (kind, name) pairs or
+        # None, and the number of definitions of each symbol.
+        self.line_symbols = [None] * buffer.get_line_count()
+        self.symbols = Counter()
+        self.packages = frozenset()
+        self.labels = LabelIndex(buffer)
+
+    def after_buffer_insert_text(self, buffer, location, text, length):
+        # location now points to the end of the inserted text.
+        added = buffer.get_line_count() - len(self.states)
+        last = location.get_line()
+        first = last - added
+        self.states[first+1:first+1] = bytes(added)
+        self.tagged[first+1:first+1] = bytes(added)
+        self.line_symbols[first+1:first+1] = [None] * added
+        self.edited()
+        self.update(first, last)
+
+    def after_buffer_delete_range(self, buffer, start, end):
+        # start and end both point to where the deleted text was.
+        removed = len(self.states) - buffer.get_line_count()
+        first = start.get_line()
+        del self.states[first+1:first+1+removed]
+        del self.tagged[first+1:first+1+removed]
+        removed_symbols = self.line_symbols[first+1:first+1+removed]
+        del self.line_symbols[first+1:first+1+removed]
+        self.symbols_changed([(first, symbols) for symbols in removed_symbols], ())
+        self.edited()
+        self.update(first, first)
+
+    def after_buffer_insert_paintable(self, buffer, location, paintable):
+        line = location.get_line()
+        self.edited()
+        self.update(line, line)
+
+    def edited(self):
+        self.generation += 1
+        self.tokens = None
 
-        self.in_comment = False
-        self.in_command = False
-        self.in_inline_math = False
-        self.at_command_end = False
-
-    def before_buffer_insert_text(self, buffer, location, text, len):
-        buffer.create_mark("insert-start", location, True)
-
-        self.in_command = False
-        self.in_inline_math = False
-        self.in_comment = False
-        self.at_command_end = False
-
-        on_tags = location.get_toggled_tags(toggled_on=True)
-        off_tags = location.get_toggled_tags(toggled_on=False)
-        in_tags =  [t for t in location.get_tags() if t not in on_tags]
-
-        for tag in in_tags:
-            match tag.props.name:
-                case "command":
-                    self.in_command = True
-                case "inline_math":
-                    self.in_inline_math = True
-                case "comment":
-                    self.in_comment = True
-
-        for tag in off_tags:
-            if tag.props.name == "command":
-                self.at_command_end = True
-
-    def after_buffer_insert_text(self, buffer, location, text, len):
-        insert_start = buffer.get_mark("insert-start")
-        start_it = buffer.get_iter_at_mark(insert_start)
-        buffer.delete_mark(insert_start)
-        end_it = location
-        self.parse(start_it, end_it)
-
-    def parse_comment(self, it):
-        comment_start = it.copy()
-        it.forward_to_line_end()
-        # handle tags in comment, tags overlapping with comment
-        it.forward_char()
-        self.buffer.apply_tag_by_name("comment", comment_start, it)
-        it.backward_char()
-
-    def parse(self, it, bound):
-        # If we are in a tag at the beginning, we don't do anything normally, but might have to break out.
-        # If we are at the end of a command/comment tag at the beginning, we have to apply that tag.
-        # Otherwise read characters one-by-one...
+    def load_text(self, text):
+        """Replace the text of the buffer by `text`.
+
+        The text is tokenized in a worker thread and highlighted from idle
+        callbacks afterwards, starting with the visible lines.
+        """
+        buffer = self.buffer
+        for handler in self.handlers:
+            buffer.handler_block(handler)
+        try:
+            buffer.props.text = text
+        finally:
+            for handler in self.handlers:
+                buffer.handler_unblock(handler)
+        self.edited()
+        self.states = bytearray(buffer.get_line_count())
+        self.tagged = bytearray(buffer.get_line_count())
+        # The symbols are known once the worker thread is done.
+        self.line_symbols = [None] * buffer.get_line_count()
+        self.symbols.clear()
+        self.labels.clear()
+        self.states_known = False
+        self.tokenize_in_thread(text)
+
+    def tokenize_in_thread(self, text):
+        generation = self.generation
+        def worker():
+            tokens = tokenize(text)
+            GLib.idle_add(self.tokenize_done, tokens, generation)
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+
+    def tokenize_done(self, tokens, generation):
+        if generation != self.generation:
+            # The buffer was edited in the meantime, start over.
+            buffer = self.buffer
+            start_it, end_it = buffer.get_bounds()
+            self.tokenize_in_thread(buffer.get_slice(start_it, end_it, True))
+            return False
+
+        self.tokens = tokens
+        self.states = tokens.line_states
+        self.states_known = True
+        # Lines edited before the tokens were ready may have been
+        # highlighted with the wrong state.
+        self.tagged = bytearray(len(self.states))
+        self.line_symbols = [None] * len(self.states)
+        self.symbols.clear()
+        self.labels.clear()
+        self.set_line_symbols(0, len(self.states), tokens.symbols)
+        self.update_packages()
+        self.highlight_visible()
+        self.schedule_highlight()
+        return False
+
+    def set_visible_lines(self, first, last):
+        """Set the lines shown in the view, and highlight them if needed."""
+        first = max(first - VISIBLE_MARGIN, 0)
+        last = last + VISIBLE_MARGIN
+        if (first, last) == self.visible_lines:
+            return
+        self.visible_lines = (first, last)
+        self.highlight_visible()
+
+    def is_visible(self, first, last):
+        visible_first, visible_last = self.visible_lines
+        return first <= visible_last and last >= visible_first
+
+    def highlight_visible(self):
+        if not self.states_known:
+            return
+        first, last = self.visible_lines
+        while self.tagged.find(0, first, last + 1) >= 0:
+            self.highlight_chunk()
+
+    def highlight_all(self):
+        """Highlight the lines that are not highlighted yet."""
+        if not self.states_known:
+            return
+        while self.highlight_chunk():
+            pass
+
+    def schedule_highlight(self):
+        if self.idle_id == 0:
+            self.idle_id = GLib.idle_add(self.highlight_idle,
+                                         priority=GLib.PRIORITY_LOW)
+
+    def highlight_idle(self):
+        if not self.states_known:
+            self.idle_id = 0
+            return False
+        deadline = time.monotonic() + IDLE_BUDGET
+        while time.monotonic() < deadline:
+            if not self.highlight_chunk():
+                self.idle_id = 0
+                self.tokens = None
+                return False
+        return True
+
+    def highlight_chunk(self):
+        """Highlight the next chunk of lines that are not highlighted yet,
+        preferring the visible lines. Returns False if there is none.
+        """
+        tagged = self.tagged
+        first, last = self.visible_lines
+        line = tagged.find(0, first, last + 1)
+        if line < 0:
+            # Continue below the visible lines, then from the start.
+            line = tagged.find(0, last)
+        if line < 0:
+            line = tagged.find(0)
+        if line < 0:
+            return False
+        end = tagged.find(1, line, line + CHUNK_LINES)
+        if end < 0:
+            end = min(line + CHUNK_LINES, len(tagged))
+
+        if self.tokens is not None:
+            tokens = self.tokens
+            start_offset = tokens.line_offsets[line]
+            first_span = bisect_left(tokens.starts, start_offset)
+            if end < len(tokens.line_offsets):
+                last_span = bisect_left(tokens.starts, tokens.line_offsets[end])
+            else:
+                last_span = len(tokens.starts)
+            groups = group_spans(tokens, first_span, last_span)
+            self.apply_spans(self.get_line_start(line),
+                             self.get_line_start(end), groups, start_offset)
+            tagged[line:end] = b"\x01" * (end - line)
+        else:
+            self.update(line, end - 1, force=True)
+        return True
+
+    def get_line_start(self, line):
+        if line >= len(self.states):
+            return self.buffer.get_end_iter()
+        _, it = self.buffer.get_iter_at_line(line)
+        return it
+
+    def update(self, first, last, force=False):
+        """Re-highlight the lines from `first` to `last`, and the lines after
+        them as long as the state at their start changes.
+
+        Lines that are not visible only get their state updated, and are
+        highlighted later, unless `force` is set for the lines up to `last`.
+        """
         buffer = self.buffer
-        if self.in_comment:
-            print("in comment")
-            if it.get_char() == "\n":
-                it.forward_char()
-                end_it =it.copy()
-                tagtable = self.buffer.get_tag_table()
-                tag = tagtable.lookup("comment")
-                end_it.forward_to_tag_toggle(tag)
-                self.buffer.remove_tag(tag, it, end_it)
-                if end_it.compare(bound) > 0:
-                    bound = end_it
-        if self.in_command:
-            if not re.match(r"[A-Za-z]", it.get_char()):
-                end_it = it.copy()
-                tagtable = self.buffer.get_tag_table()
-                tag = tagtable.lookup("command")
-                end_it.forward_to_tag_toggle(tag)
-                self.buffer.remove_tag(tag, it, end_it)
-                if end_it.compare(bound) > 0:
-                    bound = end_it
-        if self.at_command_end:
-            if re.match(r"[A-Za-z]", it.get_char()):
-                command_start = it.copy()
-                it.forward_word_end()
-                self.buffer.apply_tag_by_name("command", command_start, it)
+        states = self.states
+        n_lines = len(states)
+        # The first line whose start state may end the update.
+        check = last + 1
+        while True:
+            last = min(last, n_lines - 1)
+            start = self.get_line_start(first)
+            end = self.get_line_start(last + 1)
+            text = buffer.get_slice(start, end, True)
+            tokens = tokenize(text, states[first])
+            line_states = tokens.line_states
+
+            # The first line whose start state did not change, or None if
+            # the states still differ after `last`.
+            stop = None
+            for line in range(check, last + 2):
+                if line == n_lines or states[line] == line_states[line-first]:
+                    stop = line
+                    break
+            converged = stop is not None
+            if not converged:
+                stop = last + 1
+
+            if stop <= last:
+                limit = tokens.line_offsets[stop-first]
+                count = bisect_left(tokens.starts, limit)
+                end = self.get_line_start(stop)
+            else:
+                count = len(tokens.kinds)
+            if force or self.is_visible(first, stop - 1):
+                self.apply_spans(start, end, group_spans(tokens, 0, count), 0)
+                self.tagged[first:stop] = b"\x01" * (stop - first)
             else:
-                self.at_command_end = False
-        inline_math_start = None
-        while it.compare(bound) < 0:
-            match it.get_char():
-                case "%":
-                    self.parse_comment(it)
-                case "\\":
-                    command_start = it.copy()
-                    it.forward_char()
-                    if it.compare(bound) >= 0:
-                        self.buffer.apply_tag_by_name("command", command_start, it)
-                        self.at_command_end = True
-                        return
-                    match it.get_char():
-                        case "\\":
-                            it.forward_char()
-                            self.buffer.apply_tag_by_name("newline", command_start, it)
-                        case " ":
-                            self.buffer.apply_tag_by_name("command", command_start, it)
-                        case ch if re.match(r"[A-Za-z]", ch):
-                            it.forward_word_end()
-                            self.buffer.apply_tag_by_name("command", command_start, it)
-                            it.backward_char()
-                        case _:
-                            pass
-                case "$":
-                    peek = it.copy()
-                    peek.forward_char()
-                    if peek.get_char() != "$":
-                        if inline_math_start is not None:
-                            it.forward_char()
-                            buffer.apply_tag_by_name("inline-math",inline_math_start, it)
-                            inline_math_start = None
-                        else:
-                            inline_math_start = it.copy()
-                    else:
-                        it.forward_char()
-            it.forward_char()
+                self.tagged[first:stop] = bytes(stop - first)
+                self.schedule_highlight()
+            states[first+1:stop+1] = line_states[1:stop-first+1]
+            self.set_line_symbols(first, stop, tokens.symbols)
+            force = False
+
+            if converged:
+                break
+            # The state at the start of the next line has changed.
+            first = stop
+            last = first + CHUNK_LINES - 1
+            check = first + 1
+
+    def set_line_symbols(self, first, stop, symbols):
+        """Replace the symbols of the lines from `first` up to `stop` by
+        `symbols`, given as (line, kind, name) with lines relative to `first`.
+        """
+        new = [None] * (stop - first)
+        for line, kind, name in symbols:
+            if line < stop - first:
+                new[line] = (new[line] or ()) + ((kind, name),)
+        old = self.line_symbols[first:stop]
+        if old == new:
+            return
+        self.line_symbols[first:stop] = new
+        self.symbols_changed([(first + i, line_symbols)
+                              for i, line_symbols in enumerate(old) if line_symbols],
+                             [(first + i, line_symbols)
+                              for i, line_symbols in enumerate(new) if line_symbols])
+
+    def symbols_changed(self, removed, added):
+        """Update the symbol counts and the label index, given lists of
+        (line, symbols) pairs."""
+        symbols = self.symbols
+        packages_changed = False
+        for line, line_symbols in removed:
+            for symbol in line_symbols or ():
+                kind, name = symbol
+                if kind == LABEL:
+                    self.labels.remove(name, line)
+                symbols[symbol] -= 1
+                if symbols[symbol] <= 0:
+                    del symbols[symbol]
+                    packages_changed |= kind == PACKAGE
+        for line, line_symbols in added:
+            for symbol in line_symbols or ():
+                kind, name = symbol
+                if kind == LABEL:
+                    self.labels.add(name, line)
+                packages_changed |= kind == PACKAGE and symbol not in symbols
+                symbols[symbol] += 1
+        if packages_changed:
+            self.update_packages()
+
+    def update_packages(self):
+        packages = frozenset(name for kind, name in self.symbols
+                             if kind == PACKAGE)
+        if packages != self.packages:
+            self.packages = packages
+            self.emit("packages-changed")
+
+    def apply_spans(self, start, end, groups, offset):
+        """Replace the highlighting between `start` and `end` by the spans in
+        `groups`, whose offsets are relative to `offset` before `start`.
+        """
+        buffer = self.buffer
+        for tag in self.tags:
+            buffer.remove_tag(tag, start, end)
 
+        base = start.get_offset() - offset
+        span_start = start.copy()
+        span_end = start.copy()
+        for tag, spans in zip(self.tags, groups):
+            for i in range(0, len(spans), 2):
+                span_start.set_offset(base + spans[i])
+                span_end.set_offset(base + spans[i+1])
+                buffer.apply_tag(tag, span_start, span_end)
@@ -1,19 +1,201 @@
+import bisect
+import cairo
 import gi
-import re
+import hashlib
 import logging
+import math
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from gi.repository import GObject
 from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import GLib
 from gi.repository import Gio
 from gi.repository import Graphene
+from gi.repository import Gsk
 gi.require_version('Poppler', '0.18')
 from gi.repository import Poppler
+from . import synctex
+from .pagecache import PageCache, get_tiles
 
 logger = logging.getLogger("Texwriter")
 
 
-class PdfViewer(Gtk.Box):
+# Space around and between the pages, in pixels.
+MARGIN_X = 20
+MARGIN_Y = 10
+SPACING = 20
+
+# The byte order of cairo image surfaces.
+if sys.byteorder == "little":
+    MEMORY_FORMAT = Gdk.MemoryFormat.B8G8R8A8_PREMULTIPLIED
+else:
+    MEMORY_FORMAT = Gdk.MemoryFormat.A8R8G8B8_PREMULTIPLIED
+
+
+# Time to wait after the last zoom step before rendering the pages at the
+# new scale, in milliseconds.
+ZOOM_DELAY = 200
+
+# Pixels per point of the low resolution pass, shown until the tiles are
+# rendered.
+PREVIEW_SCALE = 0.5
+
+
+def render_image(poppler_page, scale, x, y, width, height):
+    """Render the `width` × `height` part at (`x`, `y`) of the page scaled
+    by `scale`. Returns the pixels in MEMORY_FORMAT and the stride."""
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    ctx = cairo.Context(surface)
+    ctx.set_source_rgb(1, 1, 1)
+    ctx.paint()
+    ctx.translate(-x, -y)
+    ctx.scale(scale, scale)
+    poppler_page.render(ctx)
+    surface.flush()
+    return GLib.Bytes.new(bytes(surface.get_data())), surface.get_stride()
+
+
+def page_digest(poppler_page, pixels):
+    """Return a digest of the content of `poppler_page`, given the `pixels`
+    of its preview.
+
+    The preview shows most changes of the page, but a small one, e.g. to a
+    single character, may not change a low resolution raster. So the digest
+    also covers the text and its layout and attributes, and the data of the
+    images, which Poppler gives without rendering the page again.
+    """
+    digest = hashlib.sha1()
+    def update(value):
+        digest.update(repr(value).encode("utf-8"))
+
+    update(poppler_page.get_size())
+    digest.update(pixels.get_data())
+    update(poppler_page.get_text())
+    _found, rects = poppler_page.get_text_layout()
+    update([(r.x1, r.y1, r.x2, r.y2) for r in rects])
+    for attrs in poppler_page.get_text_attributes():
+        color = attrs.color
+        update((attrs.start_index, attrs.end_index, attrs.font_name,
+                attrs.font_size, attrs.is_underlined,
+                color.red, color.green, color.blue))
+    for mapping in poppler_page.get_image_mapping():
+        area = mapping.area
+        update((area.x1, area.y1, area.x2, area.y2))
+        surface = poppler_page.get_image(mapping.image_id)
+        if surface is not None:
+            surface.flush()
+            digest.update(surface.get_data())
+    return digest.hexdigest()
+
+
+def make_texture(width, height, pixels, stride):
+    return Gdk.MemoryTexture.new(width, height, MEMORY_FORMAT, pixels, stride)
+
+
+class PageRenderer:
+    """Renders pages in a pool of worker threads.
+
+    Poppler documents cannot be shared between threads, so every worker
+    opens its own copy of the document from the same data.
+    """
+    default = None
+
+    @classmethod
+    def get_default(cls):
+        if cls.default is None:
+            cls.default = cls()
+        return cls.default
+
+    def __init__(self):
+        # Leave a core for the user interface.
+        workers = max(1, min(4, (os.cpu_count() or 1) - 1))
+        self.executor = ThreadPoolExecutor(workers, "texwriter-render")
+        self.local = threading.local()
+
+    def submit(self, func, callback, *args):
+        future = self.executor.submit(func, *args)
+        future.add_done_callback(lambda f: GLib.idle_add(callback, f))
+        return future
+
+    def render_async(self, data, index, scale, tile, callback):
+        """Render the (x, y, width, height) `tile` of page `index` of the
+        document in `data`, and call `callback(future)` in the main thread
+        when done.
+
+        The result of the future is a (width, height, pixels, stride) tuple.
+        Cancelling the returned future drops the render if it has not
+        started yet.
+        """
+        return self.submit(self.render, callback, data, index, scale, tile)
+
+    def preview_async(self, data, index, callback):
+        """Render the preview of page `index` like render_async().
+
+        The result of the future is a (width, height, pixels, stride, digest)
+        tuple. Pages with the same digest look the same, so their renders can
+        be shared.
+        """
+        return self.submit(self.preview, callback, data, index)
+
+    def get_page(self, data, index):
+        local = self.local
+        if getattr(local, "data", None) is not data:
+            local.document = Poppler.Document.new_from_bytes(data, None)
+            local.data = data
+        return local.document.get_page(index)
+
+    def render(self, data, index, scale, tile):
+        x, y, width, height = tile
+        page = self.get_page(data, index)
+        pixels, stride = render_image(page, scale, x, y, width, height)
+        return width, height, pixels, stride
+
+    def preview(self, data, index):
+        page = self.get_page(data, index)
+        size = page.get_size()
+        width = math.ceil(size[0]*PREVIEW_SCALE)
+        height = math.ceil(size[1]*PREVIEW_SCALE)
+        pixels, stride = render_image(page, PREVIEW_SCALE, 0, 0, width, height)
+        return width, height, pixels, stride, page_digest(page, pixels)
+
+
+class TextureCache(PageCache):
+    """The rendered tiles of the pages of every PDF viewer.
+
+    The memory budget is the pdf-cache-size setting.
+    """
+    default = None
+
+    @classmethod
+    def get_default(cls):
+        if cls.default is None:
+            cls.default = cls()
+        return cls.default
+
+    def __init__(self):
+        self.settings = Gio.Settings.new("com.github.molnarandris.texwriter")
+        super().__init__(self.get_budget_setting())
+        self.settings.connect("changed::pdf-cache-size",
+                              lambda *_: self.set_budget(self.get_budget_setting()))
+
+    def get_budget_setting(self):
+        return self.settings.get_int("pdf-cache-size") * 1024 * 1024
+
+
+class PdfViewer(Gtk.Widget):
+    """Shows the pages of a PDF document in a column.
+
+    Only the pages near the visible part of the viewer have widgets. The
+    position of every page is computed from the page sizes, so loading and
+    scrolling a document cost the same for any number of pages.
+
+    Reloading the document keeps the widgets and the scroll position. The
+    renders of the pages are cached by their content, so only the pages that
+    changed are rendered again.
+    """
     __gtype_name__ = 'PdfViewer'
 
     __gsignals__ = {
@@ -23,16 +205,26 @@ class PdfViewer(Gtk.Box):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.set_halign(Gtk.Align.CENTER)
-        self.set_orientation(Gtk.Orientation.VERTICAL)
-        self.set_spacing(20)
-        self.set_margin_start(20)
-        self.set_margin_end(20)
-        self.set_margin_top(10)
-        self.set_margin_bottom(10)
-
-        self._scale = 1
+
+        self.settings = Gio.Settings.new("com.github.molnarandris.texwriter")
+        self._scale = self.settings.get_double("pdf-scale")
+        # The scale the pages are rendered at. While zooming, the pages are
+        # drawn from the textures rendered at this scale.
+        self.render_scale = self._scale
+        self.zoom_id = None
         self.file = None
         self.cancellable = None
+        self.document = None
+        self.data = None
+        # The sizes of the pages in points, and the offsets of their tops in
+        # pixels at the current scale.
+        self.page_sizes = []
+        self.page_offsets = []
+        # Maps page indices to the Gtk.Overlay holding their PdfPage, for the
+        # pages near the visible part.
+        self.pages = {}
+        self.hadjustment = None
+        self.vadjustment = None
 
         controller = Gtk.EventControllerScroll()
         controller.connect("scroll", self.on_scroll)
@@ -49,32 +241,155 @@ class PdfViewer(Gtk.Box):
     @scale.setter
     def scale(self, value):
         self._scale = value
-        for child in self:
-            child.get_child().set_scale(value)
+        for overlay in self.pages.values():
+            overlay.get_child().set_scale(value)
+        self.update_layout()
+        # Render the pages again once the zoom settles.
+        if self.zoom_id is not None:
+            GLib.source_remove(self.zoom_id)
+        self.zoom_id = GLib.timeout_add(ZOOM_DELAY, self.zoom_done)
+
+    def zoom_done(self):
+        self.zoom_id = None
+        self.render_scale = self._scale
+        for overlay in self.pages.values():
+            overlay.get_child().set_render_scale(self.render_scale)
+        self.settings.set_double("pdf-scale", self._scale)
+        return False
 
     def load_file(self, file):
-        child = self.get_first_child()
-        while child is not None:
-            self.remove(child)
-            page = child.get_child()
-            page.unparent()
-            del page.poppler_page
-            del page
-            child.set_child(None)
-            del child
-            child = self.get_first_child()
         try:
-            poppler_doc = Poppler.Document.new_from_gfile(file, None, None)
-            self.file = file
-            for i in range(poppler_doc.get_n_pages()):
-                page = PdfPage(poppler_doc.get_page(i), self.scale)
+            _, contents, _ = file.load_contents(None)
+            data = GLib.Bytes.new(contents)
+            document = Poppler.Document.new_from_bytes(data, None)
+        except GLib.Error as err:
+            logger.warning(err)
+            self.clear_pages()
+            self.document = None
+            self.page_sizes = []
+            self.update_layout()
+            return
+        self.file = file
+        self.document = document
+        # The pages are rendered from the same data in worker threads, so
+        # that they match the document even if the file changes.
+        self.data = data
+        self.page_sizes = [document.get_page(i).get_size()
+                           for i in range(document.get_n_pages())]
+        for n in [n for n in self.pages if n >= len(self.page_sizes)]:
+            overlay = self.pages.pop(n)
+            overlay.get_child().cancel_renders()
+            overlay.unparent()
+        for n, overlay in self.pages.items():
+            overlay.get_child().set_page(document.get_page(n), data)
+        self.update_layout()
+
+    def clear_pages(self):
+        for overlay in self.pages.values():
+            overlay.get_child().cancel_renders()
+            overlay.unparent()
+        self.pages = {}
+
+    def do_dispose(self):
+        if self.zoom_id is not None:
+            GLib.source_remove(self.zoom_id)
+            self.zoom_id = None
+        self.clear_pages()
+        super().do_dispose()
+
+    def update_layout(self):
+        """Compute the page offsets after the pages or the scale changed."""
+        offsets = []
+        y = MARGIN_Y
+        for _width, height in self.page_sizes:
+            offsets.append(y)
+            y += height*self._scale + SPACING
+        self.page_offsets = offsets
+        self.queue_resize()
+
+    def get_vadjustment(self):
+        if self.vadjustment is None:
+            viewport = self.get_parent()
+            if not isinstance(viewport, Gtk.Scrollable):
+                return None
+            self.hadjustment = viewport.get_hadjustment()
+            self.vadjustment = viewport.get_vadjustment()
+            # Scrolling moves the viewer without allocating it again.
+            for adj in (self.hadjustment, self.vadjustment):
+                adj.connect("value-changed", lambda *_: self.queue_allocate())
+                adj.connect("notify::page-size", lambda *_: self.queue_allocate())
+        return self.vadjustment
+
+    def get_visible_rect(self):
+        """Return the visible part of the viewer as an (x, y, width, height)
+        tuple, or None if it is not known."""
+        vadj = self.get_vadjustment()
+        if vadj is None or vadj.get_page_size() <= 0:
+            return None
+        hadj = self.hadjustment
+        return (hadj.get_value(), vadj.get_value(),
+                hadj.get_page_size(), vadj.get_page_size())
+
+    def get_visible_pages(self):
+        """Return the range of the pages near the visible part."""
+        rect = self.get_visible_rect()
+        if rect is not None:
+            top = rect[1]
+            bottom = top + rect[3]
+        else:
+            top = 0
+            bottom = 2000
+        # Keep one screen of pages above and below, so that scrolling does
+        # not show missing pages.
+        margin = bottom - top
+        first = max(0, bisect.bisect_right(self.page_offsets, top - margin) - 1)
+        last = bisect.bisect_left(self.page_offsets, bottom + margin)
+        return range(first, last)
+
+    def update_pages(self):
+        """Create the widgets of the pages near the visible part, and remove
+        the others."""
+        visible = self.get_visible_pages()
+        for n in [n for n in self.pages if n not in visible]:
+            overlay = self.pages.pop(n)
+            overlay.get_child().cancel_renders()
+            overlay.unparent()
+        for n in visible:
+            if n not in self.pages:
+                page = PdfPage(self.document.get_page(n), self._scale,
+                               self.data, self.render_scale)
                 page.connect("synctex-back", self.on_synctex_back)
                 overlay = Gtk.Overlay()
                 overlay.set_child(page)
-                self.append(overlay)
-            del poppler_doc
-        except GLib.Error as err:
-            logger.warning(err)
+                overlay.set_parent(self)
+                self.pages[n] = overlay
+
+    def do_measure(self, orientation, for_size):
+        if orientation == Gtk.Orientation.HORIZONTAL:
+            width = max((w for w, _h in self.page_sizes), default=0)
+            size = int(width*self._scale) + 2*MARGIN_X
+        elif self.page_sizes:
+            _width, height = self.page_sizes[-1]
+            size = int(self.page_offsets[-1] + height*self._scale) + MARGIN_Y
+        else:
+            size = 2*MARGIN_Y
+        return size, size, -1, -1
+
+    def do_size_allocate(self, width, height, baseline):
+        self.update_pages()
+        visible = self.get_visible_rect()
+        for n, overlay in self.pages.items():
+            w, h = self.page_sizes[n]
+            w = int(w*self._scale)
+            h = int(h*self._scale)
+            x = (width - w)//2
+            y = self.page_offsets[n]
+            overlay.measure(Gtk.Orientation.HORIZONTAL, -1)
+            point = Graphene.Point().init(x, y)
+            overlay.allocate(w, h, -1, Gsk.Transform().translate(point))
+            if visible is not None:
+                vx, vy, vw, vh = visible
+                overlay.get_child().set_visible_rect((vx - x, vy - y, vw, vh))
 
     def on_scroll(self, controller, dx, dy):
         if not controller.get_current_event_state() == Gdk.ModifierType.CONTROL_MASK:
@@ -100,15 +415,18 @@ class PdfViewer(Gtk.Box):
         scroll.set_kinetic_scrolling(True)
 
     def synctex_fwd(self, rects):
+        if not rects:
+            return
+        _, _, _, y, p = rects[-1]
+        self.scroll_to(p, y)
+        # The pages are only created at the next allocation otherwise.
+        self.update_pages()
         for r in rects:
             w,h,x,y,p = r
             rect = SynctexRect(w,h,x,y, self.scale)
             page = self.get_page(p)
             page is not None and page.add_overlay(rect)
 
-        _, _, _, y, p = r
-        self.scroll_to(p, y)
-
     def on_synctex_back(self, page, x, y, around, after):
         if self.file is None: return
         arg = str(page.page_number) + ":" + str(x) + ":" + str(y)
@@ -126,33 +444,39 @@ class PdfViewer(Gtk.Box):
         logger.info("Synctex back complete")
         success, stdout, _ = source.communicate_utf8_finish(result)
         self.cancellable = None
-        if stdout is not None:
-            result = re.search("Line:(.*)", stdout)
-            line = int(result.group(1)) - 1
+        line = synctex.parse_edit(stdout) if stdout is not None else None
+        if line is not None:
             self.emit("synctex-back", line, around, after)
         else:
             logger.warning("Synctex back failed")
 
     def get_page(self, n):
-        child = self.get_first_child()
-        for i in range(n):
-            child = child.get_next_sibling()
-        return child
+        """Return the overlay of page `n`, or None if it has no widget."""
+        return self.pages.get(n)
 
     def scroll_to(self, page_num, y):
-        if self.get_page(page_num) is not None:
-            page = self.get_page(page_num).get_child()
-        else:
+        if not 0 <= page_num < len(self.page_offsets):
             return
-        point = Graphene.Point()
-        point.init(0, y)
-        _, p = page.compute_point(self, point)
-        viewport = self.get_parent()
-        vadj = viewport.get_vadjustment()
-        vadj.set_value(p.y-vadj.get_page_size()*0.302)
+        vadj = self.get_vadjustment()
+        if vadj is None:
+            return
+        y = self.page_offsets[page_num] + y*self._scale
+        vadj.set_value(y - vadj.get_page_size()*0.302)
 
 
 class PdfPage(Gtk.Widget):
+    """A page of a PDF document.
+
+    The page is drawn from the tiles in the texture cache. Only the tiles in
+    the visible part of the page are rendered, in worker threads from the
+    document in `data`. A low resolution preview of the page is rendered
+    first. It also gives the digest of the page, under which its tiles are
+    cached, so pages that did not change since the last build are drawn from
+    the cache.
+
+    The tiles are rendered at `render_scale`, and scaled to `scale` when
+    drawn, so that zooming does not render the page at every step.
+    """
     __gtype_name__ = 'PdfPage'
 
     __gsignals__ = {
@@ -160,11 +484,28 @@ class PdfPage(Gtk.Widget):
                          (float, float, str, str)),
     }
 
-    def __init__(self, poppler_page, scale=1.0):
+    def __init__(self, poppler_page, scale, data, render_scale=None):
         super().__init__()
         self.set_halign(Gtk.Align.FILL)
         self.set_valign(Gtk.Align.CENTER)
         self.poppler_page = poppler_page
+        self.data = data
+        self.cache = TextureCache.get_default()
+        self.renderer = PageRenderer.get_default()
+        # The digest of the page, None until the preview is rendered, and the
+        # digest of the page it replaced, which is shown until then.
+        self.key = None
+        self.previous_key = None
+        self.render_scale = render_scale if render_scale is not None else scale
+        # The previous render scale, whose tiles are shown until the tiles at
+        # the render scale are ready.
+        self.previous_scale = None
+        # The visible part of the page, or None if the whole page is.
+        self.visible_rect = None
+        self.tiles = None
+        # Maps the cache keys of the tiles being rendered, and "preview", to
+        # their futures.
+        self.pending = {}
         self.bg_color = Gdk.RGBA()
         self.bg_color.parse("white")
         self.set_scale(scale)
@@ -173,6 +514,18 @@ class PdfPage(Gtk.Widget):
         controller.connect("released", self.on_click)
         self.add_controller(controller)
 
+    def set_page(self, poppler_page, data):
+        """Show `poppler_page` of the document in `data` instead, e.g. after
+        the document was built again."""
+        self.cancel_renders()
+        if self.key is not None:
+            self.previous_key = self.key
+        self.key = None
+        self.poppler_page = poppler_page
+        self.data = data
+        self.set_scale(self.scale)
+        self.queue_draw()
+
     @property
     def page_number(self):
         return self.poppler_page.get_index()+1
@@ -207,17 +560,146 @@ class PdfPage(Gtk.Widget):
     def set_scale(self, scale):
         width, height = self.poppler_page.get_size()
         self.scale = scale
-        self.set_size_request(scale*width, scale*height)
+        self.set_size_request(int(scale*width), int(scale*height))
+
+    def set_render_scale(self, scale):
+        if scale != self.render_scale:
+            self.previous_scale = self.render_scale
+            self.render_scale = scale
+            self.queue_draw()
+
+    def get_tiles(self, render_scale=None):
+        """Return the scale in device pixels per point and the tiles of the
+        visible part of the page rendered at `render_scale`."""
+        if render_scale is None:
+            render_scale = self.render_scale
+        factor = self.get_scale_factor()
+        scale = render_scale*factor
+        pw, ph = self.poppler_page.get_size()
+        rect = self.visible_rect
+        if rect is not None:
+            ratio = render_scale/self.scale*factor
+            rect = tuple(v*ratio for v in rect)
+        return scale, get_tiles(math.ceil(pw*scale), math.ceil(ph*scale), rect)
+
+    def get_textures(self, key, scale, tiles):
+        """Return the (texture, rect) pairs of the cached `tiles` of the page
+        `key` rendered at `scale`, and the (key, tile) pairs of the missing
+        ones."""
+        ratio = self.scale/scale
+        textures = []
+        missing = []
+        for x, y, width, height in tiles:
+            tile_key = (key, scale, x, y)
+            texture = self.cache.get(tile_key)
+            if texture is None:
+                missing.append((tile_key, (x, y, width, height)))
+            else:
+                rect = Graphene.Rect().init(x*ratio, y*ratio,
+                                            width*ratio, height*ratio)
+                textures.append((texture, rect))
+        return textures, missing
+
+    def set_visible_rect(self, rect):
+        """Set the visible part of the page as an (x, y, width, height)
+        tuple in the coordinates of the page."""
+        self.visible_rect = rect
+        tiles = self.get_tiles()
+        if tiles != self.tiles:
+            scale, visible = tiles
+            keep = {(self.key, scale, x, y) for x, y, _w, _h in visible}
+            keep.add("preview")
+            self.cancel_renders(keep)
+            self.queue_draw()
+
+    def render_async(self, key, scale, tile):
+        if key in self.pending:
+            return
+        index = self.poppler_page.get_index()
+        self.pending[key] = self.renderer.render_async(
+            self.data, index, scale, tile,
+            lambda future: self.render_done(key, future))
+
+    def render_preview(self):
+        if "preview" in self.pending:
+            return
+        index = self.poppler_page.get_index()
+        self.pending["preview"] = self.renderer.preview_async(
+            self.data, index, lambda future: self.preview_done(future))
+
+    def get_result(self, key, future):
+        """Return the result of the render of `key`, or None if it was
+        cancelled or failed."""
+        if self.pending.get(key) is not future or future.cancelled():
+            return None
+        del self.pending[key]
+        try:
+            return future.result()
+        except GLib.Error as err:
+            logger.warning(err)
+            return None
+
+    def render_done(self, key, future):
+        result = self.get_result(key, future)
+        if result is not None:
+            width, height, pixels, stride = result
+            texture = make_texture(width, height, pixels, stride)
+            self.cache.put(key, texture, width*height*4)
+            self.queue_draw()
+        return False
+
+    def preview_done(self, future):
+        result = self.get_result("preview", future)
+        if result is not None:
+            width, height, pixels, stride, digest = result
+            self.key = digest
+            self.previous_key = None
+            texture = make_texture(width, height, pixels, stride)
+            self.cache.put((digest, "preview"), texture, width*height*4)
+            self.queue_draw()
+        return False
+
+    def cancel_renders(self, keep=()):
+        """Cancel the renders of the tiles that are not in `keep`."""
+        for key in [key for key in self.pending if key not in keep]:
+            self.pending.pop(key).cancel()
 
     def do_snapshot(self, snapshot):
         """ This virtual function manages the display of the widget.
         """
         pw, ph = self.poppler_page.get_size()
-        rect = Graphene.Rect().init(0, 0, self.scale*pw, self.scale*ph)
-        snapshot.append_color(self.bg_color, rect)
-        ctx = snapshot.append_cairo(rect)
-        ctx.scale(self.scale, self.scale)
-        self.poppler_page.render(ctx)
+        page_rect = Graphene.Rect().init(0, 0, self.scale*pw, self.scale*ph)
+        snapshot.append_color(self.bg_color, page_rect)
+        self.tiles = self.get_tiles()
+        key = self.key
+        if key is None:
+            # Until the digest of the page is known, show the page it
+            # replaced, which is most likely the same.
+            self.render_preview()
+            key = self.previous_key
+            if key is None:
+                return
+        scale, tiles = self.tiles
+        textures, missing = self.get_textures(key, scale, tiles)
+        if missing:
+            # Show the preview until the tiles are rendered.
+            preview = self.cache.get((key, "preview"))
+            if preview is not None:
+                snapshot.append_texture(preview, page_rect)
+            elif key == self.key:
+                self.render_preview()
+            if self.previous_scale is not None:
+                old_tiles = self.get_tiles(self.previous_scale)
+                old_textures, _ = self.get_textures(key, *old_tiles)
+                textures = old_textures + textures
+        else:
+            self.previous_scale = None
+        # While zooming, the tiles are rendered once the zoom settles.
+        if key == self.key and self.render_scale == self.scale:
+            for tile_key, tile in missing:
+                self.render_async(tile_key, scale, tile)
+        for texture, rect in textures:
+            snapshot.append_texture(texture, rect)
 
 
 class SynctexRect(Gtk.Widget):
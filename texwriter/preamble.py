@@ -0,0 +1,68 @@
+"""Precompiled preamble formats.
+
+The preamble of a document, everything before \\begin{document}, is dumped
+into a format file with mylatexformat. Compiling with that format skips the
+preamble, so the packages are not loaded again on every build.
+"""
+
+import hashlib
+import os
+import re
+
+# Number of format files kept in the cache.
+MAX_FORMATS = 8
+
+begin_document_re = re.compile(r"^[^%\n]*?\\begin\s*\{document\}", re.M)
+
+
+def get_preamble(text):
+    """Return the preamble of `text`, or None if it has no
+    \\begin{document}."""
+    match = begin_document_re.search(text)
+    if match is None:
+        return None
+    return text[:match.end()]
+
+
+def format_name(preamble, directory):
+    """Return the name of the format of `preamble` in a document in
+    `directory`.
+
+    The directory is part of the name because files loaded by the preamble
+    are looked up relative to it.
+    """
+    data = directory.encode("utf-8") + b"\0" + preamble.encode("utf-8")
+    return "preamble-" + hashlib.sha1(data).hexdigest()
+
+
+def format_command(name, format_dir, path):
+    """Return the command line dumping the preamble of the document at
+    `path` to the format `name` in `format_dir`."""
+    return ['etex', '-ini', '-interaction=nonstopmode',
+            '-output-directory=' + format_dir, '-jobname=' + name,
+            '&pdflatex', 'mylatexformat.ltx', path]
+
+
+def prune_formats(format_dir, keep=MAX_FORMATS):
+    """Delete all but the `keep` most recently used formats in
+    `format_dir`."""
+    try:
+        entries = [e for e in os.scandir(format_dir)
+                   if e.name.startswith("preamble-")]
+    except OSError:
+        return
+    formats = {}
+    for entry in entries:
+        name = entry.name.split(".", 1)[0]
+        try:
+            mtime = entry.stat().st_mtime
+        except OSError:
+            continue
+        formats[name] = max(mtime, formats.get(name, 0))
+    old = sorted(formats, key=formats.__getitem__, reverse=True)[keep:]
+    for entry in entries:
+        if entry.name.split(".", 1)[0] in old:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
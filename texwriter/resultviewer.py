@@ -6,6 +6,7 @@ class ResultViewer(Gtk.Stack):
 
     pdfview = Gtk.Template.Child()
     logview = Gtk.Template.Child()
+    historyview = Gtk.Template.Child()
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -0,0 +1,29 @@
+import re
+
+view_record_re = re.compile(r"Page:(.*)\n.*\n.*\nh:(.*)\nv:(.*)\nW:(.*)\nH:(.*)")
+edit_line_re = re.compile(r"Line:(.*)")
+
+
+def parse_view(text):
+    """Return the rectangles in the output of `synctex view`.
+
+    Each rectangle is a (width, height, x, y, page) tuple, with pages
+    numbered from 0.
+    """
+    rectangles = []
+    for match in view_record_re.finditer(text):
+        page = int(match.group(1)) - 1
+        x = float(match.group(2))
+        y = float(match.group(3))
+        width = float(match.group(4))
+        height = float(match.group(5))
+        rectangles.append((width, height, x, y, page))
+    return rectangles
+
+
+def parse_edit(text):
+    """Return the 0-based line in the output of `synctex edit`, or None."""
+    match = edit_line_re.search(text)
+    if match is None:
+        return None
+    return int(match.group(1)) - 1
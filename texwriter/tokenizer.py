@@ -0,0 +1,159 @@
+import re
+from array import array
+from collections import namedtuple
+
+# Lexer states at the start of a line.
+TEXT = 0
+INLINE_MATH = 1
+
+# Token kinds. KIND_NAMES gives the name of the buffer tag for each kind.
+COMMAND = 0
+COMMENT = 1
+NEWLINE = 2
+MATH = 3
+KIND_NAMES = ("command", "comment", "newline", "inline-math")
+
+# One alternative per token, tried in order. Only the numbered groups produce
+# spans, the unnamed alternatives skip control symbols like \$ or \% and $$.
+token_re = re.compile(r"(%.*)|(\\\\)|(\\(?:[A-Za-z]+| ))|\\.?|\$\$|(\$)")
+TOKEN_COMMENT = 1
+TOKEN_NEWLINE = 2
+TOKEN_COMMAND = 3
+TOKEN_DOLLAR = 4
+
+# Symbol kinds, and the commands whose argument is a symbol of that kind.
+PACKAGE = "package"
+LABEL = "label"
+SYMBOL_COMMANDS = {
+    "\\documentclass": PACKAGE,
+    "\\usepackage": PACKAGE,
+    "\\RequirePackage": PACKAGE,
+    "\\label": LABEL,
+}
+argument_re = re.compile(r"\s*(?:\[[^\]]*\])?\s*\{([^}]*)\}")
+
+# The commands referencing labels, as a regular expression. Some of them take
+# a comma separated list of labels.
+REFERENCE_COMMAND = r"\\(?:eq|page|auto|name|c|C)?ref\*?"
+
+eol_re = re.compile("\r\n?|\n|\u2029")
+blank_re = re.compile(r"\s*")
+
+# kinds, starts and ends are parallel arrays of token spans, ordered by line
+# and never crossing a line end. line_offsets and line_states hold the offset
+# of and the lexer state at the start of each line of the text. symbols is a
+# list of (line, kind, name) tuples, e.g. (0, PACKAGE, "amsmath").
+Tokens = namedtuple("Tokens", ["kinds", "starts", "ends",
+                               "line_offsets", "line_states", "symbols"])
+
+
+def tokenize(text, state=TEXT):
+    """Tokenize `text`, starting in lexer state `state`.
+
+    If `text` ends with a line end, the last entry of line_states is the state
+    at the start of the line following the text.
+    """
+    kinds = array("B")
+    starts = array("l")
+    ends = array("l")
+    line_offsets = array("l")
+    line_states = bytearray()
+    symbols = []
+
+    finditer = token_re.finditer
+    blank = blank_re.fullmatch
+    eols = eol_re.finditer(text)
+    length = len(text)
+    pos = 0
+    while True:
+        eol = next(eols, None)
+        line_end = eol.start() if eol is not None else length
+        line_offsets.append(pos)
+        line_states.append(state)
+
+        # TeX does not allow a paragraph break in inline math, so a blank
+        # line always resets the state. This also bounds how far the effect
+        # of an edit propagates.
+        if blank(text, pos, line_end):
+            state = TEXT
+        else:
+            math_start = pos if state == INLINE_MATH else -1
+            code_end = line_end
+            for match in finditer(text, pos, line_end):
+                token = match.lastindex
+                if token is None:
+                    continue
+                if token == TOKEN_COMMAND:
+                    kinds.append(COMMAND)
+                    symbol = SYMBOL_COMMANDS.get(match.group(TOKEN_COMMAND))
+                    if symbol is not None:
+                        argument = argument_re.match(text, match.end(), line_end)
+                        if argument is not None:
+                            line = len(line_offsets) - 1
+                            names = argument.group(1)
+                            # Packages can be loaded several at once.
+                            if symbol == PACKAGE:
+                                names = names.split(",")
+                            else:
+                                names = (names,)
+                            for name in names:
+                                name = name.strip()
+                                if name:
+                                    symbols.append((line, symbol, name))
+                elif token == TOKEN_DOLLAR:
+                    if math_start < 0:
+                        math_start = match.start()
+                        continue
+                    kinds.append(MATH)
+                    starts.append(math_start)
+                    ends.append(match.end())
+                    math_start = -1
+                    continue
+                elif token == TOKEN_NEWLINE:
+                    kinds.append(NEWLINE)
+                else:
+                    code_end = match.start()
+                    if 0 <= math_start < code_end:
+                        kinds.append(MATH)
+                        starts.append(math_start)
+                        ends.append(code_end)
+                    kinds.append(COMMENT)
+                    starts.append(code_end)
+                    ends.append(line_end)
+                    break
+                starts.append(match.start())
+                ends.append(match.end())
+            else:
+                if 0 <= math_start < code_end:
+                    kinds.append(MATH)
+                    starts.append(math_start)
+                    ends.append(code_end)
+            state = TEXT if math_start < 0 else INLINE_MATH
+
+        if eol is None:
+            break
+        pos = eol.end()
+
+    return Tokens(kinds, starts, ends, line_offsets, line_states, symbols)
+
+
+def group_spans(tokens, first=0, last=None):
+    """Group the spans of `tokens` with index from `first` up to `last` by
+    kind.
+
+    Returns one flat array [start, end, start, end, ...] per kind, with
+    adjacent spans of the same kind merged, so that a tag can be applied with
+    as few calls as possible.
+    """
+    if last is None:
+        last = len(tokens.kinds)
+    groups = [array("l") for _ in KIND_NAMES]
+    kinds, starts, ends = tokens.kinds, tokens.starts, tokens.ends
+    for i in range(first, last):
+        group = groups[kinds[i]]
+        if group and group[-1] == starts[i]:
+            group[-1] = ends[i]
+        else:
+            group.append(starts[i])
+            group.append(ends[i])
+    return groups
@@ -24,8 +24,12 @@ from gi.repository import GLib
 from gi.repository import Gdk
 from .pdfviewer import PdfViewer
 from .logviewer import LogViewer
+from .logparser import ERROR
 from .editorpage import EditorPage
+from .builder import BuildScheduler
+from .buildstats import CANCELLED
 from .resultviewer import ResultViewer
+from .historyview import BuildHistoryView
 
 import sys
 import re
@@ -50,9 +54,13 @@ class TexwriterWindow(Adw.ApplicationWindow):
         self.result_stack.set_visible_child_name("empty")
         editorpage = EditorPage()
         self.tabview.append(editorpage)
+        editorpage.connect("compile-requested",
+                           lambda editor: self.compile(editor, editor.draft))
+        editorpage.connect("build-output", self.on_build_output)
         self.title_binding = editorpage.bind_property("title", self.title, "label")
         result_view = ResultViewer()
         editorpage.result_view = result_view
+        result_view.historyview.set_history(editorpage.build_history)
         self.editorpage = editorpage
         self.result_stack.add(result_view)
         self.result_stack.set_visible_child(result_view)
@@ -80,10 +88,33 @@ class TexwriterWindow(Adw.ApplicationWindow):
         action.connect("activate", self.on_compile_action)
         self.add_action(action)
 
+        action = Gio.SimpleAction.new("show-build-history", None)
+        action.connect("activate", self.on_show_build_history_action)
+        self.add_action(action)
+
+        action = Gio.SimpleAction.new("export-build-history", None)
+        action.connect("activate", self.on_export_build_history_action)
+        self.add_action(action)
+
+        action = Gio.SimpleAction.new("cancel-compile", None)
+        action.connect("activate", self.on_cancel_compile_action)
+        self.add_action(action)
+
+        action = Gio.SimpleAction.new("compile-draft", None)
+        action.connect("activate", self.on_compile_draft_action)
+        self.add_action(action)
+
+        action = settings.create_action("auto-compile")
+        self.add_action(action)
+
         action = Gio.SimpleAction.new("synctex-fwd", None)
         action.connect("activate", self.on_synctex_fwd_action)
         self.add_action(action)
 
+        action = Gio.SimpleAction.new("goto-definition", None)
+        action.connect("activate", self.on_goto_definition_action)
+        self.add_action(action)
+
         action = Gio.SimpleAction.new("convert-inline-math", None)
         action.connect("activate", self.on_convert_inline_math_action)
         self.add_action(action)
@@ -97,6 +128,7 @@ class TexwriterWindow(Adw.ApplicationWindow):
         # TODO: override textbuffer's do_modified_changed.
         self.title_binding = None
         self.tabview.connect("notify::selected-page", self.tab_page_change_cb)
+        self.connect("notify::is-active", self.on_active_changed)
         self.force_close = False
         # Keep track whether there is an ongoing operation.
         # If yes, we have to cancel it before starting a new one.
@@ -108,6 +140,16 @@ class TexwriterWindow(Adw.ApplicationWindow):
         self.editorpage.unbind(self.title_binding)
         self.editorpage = self.tabview.props.selected_page
         self.title_binding = self.editorpage.bind_property("title", self.title, "label")
+        if self.props.is_active:
+            BuildScheduler.get_default().set_focused(self.editorpage)
+
+    def on_active_changed(self, window, pspec):
+        if self.props.is_active:
+            BuildScheduler.get_default().set_focused(self.editorpage)
+
+    def get_editor_pages(self):
+        pages = self.tabview.get_pages()
+        return [pages.get_item(i).get_child() for i in range(pages.get_n_items())]
 
     def notify(self, str):
         toast = Adw.Toast.new(str)
@@ -133,20 +175,17 @@ class TexwriterWindow(Adw.ApplicationWindow):
         pdfview.connect("synctex-back", lambda _, line, around, after: self.scroll_to(editorpage, line, after))
         logview.connect("row-activated", lambda _, row: self.scroll_to(editorpage, row.line, row.text))
         result_view.connect("notify::visible-child-name", self.stack_change_cb)
-        # settings.bind("pdf-scale", self.pdfview, "scale", Gio.SettingsBindFlags.DEFAULT)
 
         self.load_pdf(editorpage)
         self.load_log(editorpage)
 
     def load_pdf(self, editor):
-        pdfpath = editor.file.get_path()[:-3] + "pdf"
-        pdffile = Gio.File.new_for_path(pdfpath)
+        pdffile = editor.output_file("pdf")
         editor.result_view.pdfview.load_file(pdffile)
 
-    def load_log(self, editor):
-        logpath = editor.file.get_path()[:-3] + "log"
-        logfile = Gio.File.new_for_path(logpath)
-        editor.result_view.logview.load_file(logfile)
+    def load_log(self, editor, callback=None):
+        logfile = editor.output_file("log")
+        editor.result_view.logview.load_file(logfile, callback)
 
     def on_save_action(self, action, param):
         save_as = param == GLib.Variant("b", True)
@@ -176,6 +215,7 @@ class TexwriterWindow(Adw.ApplicationWindow):
             editorpage.save_file_finish(result)
         except GLib.Error as err:
             self.notify(f"Unable to save file: {err.message}")
+            return
 
         if callback is not None:
             callback()
@@ -185,41 +225,128 @@ class TexwriterWindow(Adw.ApplicationWindow):
     def on_compile_action(self, action, param):
         self.compile()
 
+    def on_compile_draft_action(self, action, param):
+        self.compile(draft=True)
+
+    def on_cancel_compile_action(self, action, param):
+        self.editorpage.cancel_compile()
+
     # TODO: check gnome builder for chained actions. Builders run button is similar
     # Look at    gnome-builder/src/libide/gui/ide-run-button.c
     # Also at gnome-builder/src/libide/foundry/ide-run-manager.c
-    def compile(self):
-        editor = self.editorpage
+    def compile(self, editor=None, draft=False):
+        """Save and compile `editor`, the current page by default. If `draft`
+        is True, only the part around the cursor is compiled.
+
+        If the editor is being saved or compiled, or its build is waiting
+        for its turn, it is compiled again when that build finishes. All the
+        requests made in the meantime result in that one build, a draft if
+        the last request was for a draft.
+        """
+        if editor is None:
+            editor = self.editorpage
+        if editor.building:
+            editor.compile_pending = draft
+            return
         # If needs saving, save first, then compile.
+        if editor.modified and editor.file is None:
+            self.save(callback=lambda: self.compile(editor, draft))
+            return
+        editor.building = True
+        record = editor.begin_build(draft)
         if editor.modified:
-            self.save(callback=self.compile)
+            editor.begin_stage(record, "save")
+            editor.save_file_async(None, self.compile_save_complete,
+                                   (draft, record))
+            return
+        self.queue_build(editor, draft, record)
+
+    def queue_build(self, editor, draft, record):
+        # Builds wait for their turn in the application wide scheduler.
+        def start():
+            editor.end_stage(record, "queue")
+            # The log is cleared when LaTeX starts, so it is kept if the
+            # outputs are up to date.
+            editor.compile_async(None, self.compile_complete, record,
+                                 draft=draft, record=record)
+        def dropped():
+            editor.end_stage(record, "queue", outcome=CANCELLED)
+            editor.building = False
+        editor.begin_stage(record, "queue")
+        BuildScheduler.get_default().submit(editor, start, dropped)
+
+    def compile_all(self):
+        """Compile every open document that has a file."""
+        for editor in self.get_editor_pages():
+            if editor.file is not None:
+                self.compile(editor, editor.draft)
+
+    def compile_save_complete(self, editor, result, data):
+        draft, record = data
+        try:
+            editor.save_file_finish(result)
+        except GLib.Error as err:
+            editor.end_stage(record, "save", err)
+            editor.building = False
+            editor.compile_pending = None
+            self.notify(f"Unable to save file: {err.message}")
             return
-        editor.compile_async(None, self.compile_complete)
+        editor.end_stage(record, "save")
+        self.queue_build(editor, draft, record)
 
-    def compile_complete(self, editor, result, user_data):
+    def on_build_output(self, editor, line):
+        entries = editor.result_view.logview.add_line(line)
+        if any(entry.kind == ERROR for entry in entries):
+            editor.result_view.set_visible_child_name("log")
+
+    def compile_complete(self, editor, result, record):
+        BuildScheduler.get_default().done(editor)
+        editor.building = False
+        if editor.closed:
+            # The build was stopped when the window was closed.
+            editor.compile_task = None
+            return
+        # False if the outputs of the last build were up to date.
+        built = True
         try:
-            editor.compile_finish(result)
+            built = editor.compile_finish(result)
         except GLib.Error as err:
             display_name = editor.display_name
-            self.notify(f"Compilation of {display_name} failed: {err.message}")
-            editor.result_view.set_visible_child_name("log")
+            if err.matches(Gio.io_error_quark(), Gio.IOErrorEnum.CANCELLED):
+                self.notify(f"Compilation of {display_name} was cancelled")
+            else:
+                self.notify(f"Compilation of {display_name} failed: {err.message}")
+                editor.result_view.set_visible_child_name("log")
         else:
-            self.load_pdf(editor)
+            if built:
+                editor.begin_stage(record, "pdf-load")
+                self.load_pdf(editor)
+                editor.end_stage(record, "pdf-load")
             editor.result_view.set_visible_child_name("pdf")
-            editor.synctex_async(None, self.synctex_complete, None)
+            editor.begin_stage(record, "synctex")
+            editor.synctex_async(None, self.synctex_complete, record)
         finally:
-            self.load_log(editor)
+            if built:
+                editor.begin_stage(record, "log-load")
+                self.load_log(editor, lambda: editor.end_stage(record, "log-load"))
+
+        if editor.compile_pending is not None:
+            draft = editor.compile_pending
+            editor.compile_pending = None
+            self.compile(editor, draft)
 
     def on_synctex_fwd_action(self, action, param):
         editor = self.editorpage
         editor.synctex_async(None, self.synctex_complete, None)
 
-    def synctex_complete(self, editor, result, user_data):
+    def synctex_complete(self, editor, result, record):
         try:
             rects = editor.synctex_finish(result)
         except GLib.Error as err:
+            editor.end_stage(record, "synctex", err)
             self.notify(err.message)
             return
+        editor.end_stage(record, "synctex")
         editor.result_view.set_visible_child_name("pdf")
         pdfview = editor.result_view.pdfview
         pdfview.synctex_fwd(rects)
@@ -253,6 +380,8 @@ class TexwriterWindow(Adw.ApplicationWindow):
                 settings.set_string("file", editor.file.get_path())
             else:
                 settings.set_string("file", "")
+            for editor in self.get_editor_pages():
+                editor.close()
             return False
 
     def close_request_complete(self, dialog, response):
@@ -273,7 +402,7 @@ class TexwriterWindow(Adw.ApplicationWindow):
         match result_view.get_visible_child_name():
             case "pdf":
                 result_view.set_visible_child_name("log")
-            case "log":
+            case "log" | "history":
                 result_view.set_visible_child_name("pdf")
             case _:
                 logger.warning("Pdf log switch button clicked while stack is not visible")
@@ -286,6 +415,36 @@ class TexwriterWindow(Adw.ApplicationWindow):
             self.pdf_log_switch.set_icon_name("pdf-symbolic")
             self.pdf_log_switch.set_tooltip_text("View pdf")
 
+    def on_show_build_history_action(self, action, param):
+        self.editorpage.result_view.set_visible_child_name("history")
+
+    def on_export_build_history_action(self, action, param):
+        dialog = Gtk.FileDialog()
+        dialog.set_initial_name("build-history.json")
+        dialog.save(self, None, self.export_build_history_cb, self.editorpage)
+
+    def export_build_history_cb(self, dialog, result, editor):
+        try:
+            file = dialog.save_finish(result)
+        except GLib.Error as err:
+            if not err.matches(Gtk.dialog_error_quark(), Gtk.DialogError.DISMISSED):
+                self.notify(f"Unable to export build history: {err.message}")
+            return
+        data = editor.build_history.to_json().encode("utf-8")
+        file.replace_contents_bytes_async(GLib.Bytes.new(data), None, False,
+                                          Gio.FileCreateFlags.NONE, None,
+                                          self.export_build_history_complete)
+
+    def export_build_history_complete(self, file, result):
+        try:
+            file.replace_contents_finish(result)
+        except GLib.Error as err:
+            self.notify(f"Unable to export build history: {err.message}")
+
+    def on_goto_definition_action(self, action, param):
+        if not self.editorpage.goto_definition():
+            self.notify("No label found for the reference at the cursor")
+
     def on_convert_inline_math_action(self, action, param):
         self.editorpage.convert_inline_math()
 